@@ -2,11 +2,18 @@ import os
 import sqlite3
 import logging
 import asyncio
+import threading
+import time
+from bisect import insort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from fastapi import FastAPI, Request, Response, HTTPException
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ContextTypes, filters
+    CallbackQueryHandler, ContextTypes, TypeHandler, filters
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -15,15 +22,76 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID = os.environ.get("ADMIN_ID")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+BOT_API_URL = os.environ.get("BOT_API_URL")  # e.g. a local Bot API server or the load test stub
 
 if not BOT_TOKEN or not WEBHOOK_URL:
     raise RuntimeError("BOT_TOKEN и WEBHOOK_URL должны быть заданы")
 
 # --- DB setup ---
-conn = sqlite3.connect("chat_stats.db", check_same_thread=False)
-cursor = conn.cursor()
+DB_PATH = os.environ.get("DB_PATH", "chat_stats.db")
+DB_READERS = int(os.environ.get("DB_READERS", 4))
 
-cursor.execute("""
+class Database:
+    """SQLite behind one writer thread and a pool of readers, awaited from handlers.
+
+    Writes run in submission order on the writer, each call in its own
+    transaction. In WAL mode readers see the last commit without waiting for it.
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.local = threading.local()
+        self.writer = ThreadPoolExecutor(1, "db-writer", initializer=self._open, initargs=(False,))
+        self.readers = ThreadPoolExecutor(readers, "db-reader", initializer=self._open, initargs=(True,))
+
+    def _open(self, read_only):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        else:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        self.local.conn = conn
+
+    def _call(self, func, *args):
+        conn = self.local.conn
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def write(self, func, *args):
+        """Queue func(conn, *args) on the writer now, the returned future can be awaited later."""
+        return asyncio.wrap_future(self.writer.submit(self._call, func, *args))
+
+    def read(self, func, *args):
+        return asyncio.wrap_future(self.readers.submit(self._call, func, *args))
+
+    def run_sync(self, func, *args):
+        # For setup before the event loop runs
+        return self.writer.submit(self._call, func, *args).result()
+
+    async def execute(self, *statements):
+        """Run (sql, params) statements in one transaction."""
+        await self.write(lambda conn: [conn.execute(sql, params) for sql, params in statements])
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+
+db = Database(DB_PATH)
+
+def create_tables(conn):
+    conn.execute("""
 CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER,
     chat_id INTEGER,
@@ -34,7 +102,34 @@ CREATE TABLE IF NOT EXISTS users (
     PRIMARY KEY (user_id, chat_id)
 )
 """)
-conn.commit()
+    # period: hour/day written by the counter, week/month produced by the rollup job
+    conn.execute("""
+CREATE TABLE IF NOT EXISTS activity (
+    period TEXT,
+    bucket INTEGER,
+    chat_id INTEGER,
+    user_id INTEGER,
+    count INTEGER DEFAULT 0,
+    PRIMARY KEY (period, bucket, chat_id, user_id)
+) WITHOUT ROWID
+""")
+    conn.execute("CREATE INDEX IF NOT EXISTS users_chat_id ON users (chat_id)")
+    # last_chat_id is the checkpoint: every chat up to it got the message or failed
+    conn.execute("""
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY,
+    admin_chat_id INTEGER,
+    text TEXT,
+    status TEXT DEFAULT 'running',
+    last_chat_id INTEGER,
+    total INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    created_at INTEGER
+)
+""")
+
+db.run_sync(create_tables)
 
 messages = {
     "ru": {
@@ -50,7 +145,15 @@ messages = {
         "contact_admin": "📨 Связь с админом: @{admin_username}",
         "only_admin": "⛔ Только для админа.",
         "no_data": "Нет данных.",
-        "top": "🏆 Топ участников:\n\n{top_list}"
+        "top": "🏆 Топ участников:\n\n{top_list}",
+        "stats_window": "📊 Твоя активность {period}: 💬 {count}",
+        "top_window": "🏆 Топ участников {period}:\n\n{top_list}",
+        "periods": {"day": "за сегодня", "week": "за неделю", "month": "за месяц"},
+        "broadcast_usage": "Напиши команду /broadcast <текст>, /broadcast cancel остановит рассылку",
+        "broadcast_progress": "📣 Рассылка #{id}: ✅ {sent} ❌ {failed} из {total}, {rate} сообщ./с",
+        "broadcast_done": "📣 Рассылка #{id} завершена: ✅ {sent} ❌ {failed} из {total}",
+        "broadcast_cancelled": "🛑 Рассылка #{id} остановлена: ✅ {sent} ❌ {failed} из {total}",
+        "broadcast_stopping": "🛑 Рассылка останавливается."
     },
     "en": {
         "start": "👋 Hi! I track chat stats. Type /menu.",
@@ -65,94 +168,459 @@ messages = {
         "contact_admin": "📨 Contact admin: @{admin_username}",
         "only_admin": "⛔ Admins only.",
         "no_data": "No data.",
-        "top": "🏆 Top users:\n\n{top_list}"
+        "top": "🏆 Top users:\n\n{top_list}",
+        "stats_window": "📊 Your activity {period}: 💬 {count}",
+        "top_window": "🏆 Top users {period}:\n\n{top_list}",
+        "periods": {"day": "today", "week": "this week", "month": "this month"},
+        "broadcast_usage": "Type /broadcast <text>, /broadcast cancel stops the broadcast",
+        "broadcast_progress": "📣 Broadcast #{id}: ✅ {sent} ❌ {failed} of {total}, {rate} msg/s",
+        "broadcast_done": "📣 Broadcast #{id} finished: ✅ {sent} ❌ {failed} of {total}",
+        "broadcast_cancelled": "🛑 Broadcast #{id} cancelled: ✅ {sent} ❌ {failed} of {total}",
+        "broadcast_stopping": "🛑 Stopping the broadcast."
     }
 }
 
-def get_user_language(user_id, chat_id):
-    cursor.execute("SELECT language FROM users WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-    row = cursor.fetchone()
+# --- Leaderboard ---
+TOP_N = 10
+WELCOME_TTL = 30
+
+def select_chat_counts(conn, chat_id):
+    return conn.execute("SELECT user_id, username, message_count FROM users WHERE chat_id=?", (chat_id,)).fetchall()
+
+class Leaderboard:
+    """Per-chat top-N kept in memory, loaded from SQLite on first use."""
+
+    def __init__(self, size=TOP_N):
+        self.size = size
+        self.counts = {}  # chat_id -> {user_id: count}
+        self.names = {}   # chat_id -> {user_id: username}
+        self.tops = {}    # chat_id -> sorted [(-count, user_id)]
+        self.loading = {}  # chat_id -> future of the load in progress
+        self.missed = {}  # chat_id -> [(user_id, name)] counted while loading
+
+    async def load(self, chat_id, flushed, rows):
+        await flushed
+        rows = await rows
+        self.counts[chat_id] = {user_id: count for user_id, _, count in rows}
+        self.names[chat_id] = {user_id: name for user_id, name, _ in rows}
+        self.tops[chat_id] = sorted((-count, user_id) for user_id, _, count in rows)[:self.size]
+        for user_id, name in self.missed.pop(chat_id, []):
+            self.increment(chat_id, user_id, name)
+
+    def increment(self, chat_id, user_id, name=None):
+        counts = self.counts.get(chat_id)
+        if counts is None:
+            if chat_id in self.missed:
+                self.missed[chat_id].append((user_id, name))
+            return  # Not loaded yet, top() flushes to SQLite before loading
+        if user_id not in counts:
+            self.names[chat_id][user_id] = name
+        old = counts.get(user_id, 0)
+        counts[user_id] = old + 1
+        top = self.tops[chat_id]
+        if (-old, user_id) in top:
+            top.remove((-old, user_id))
+        elif len(top) >= self.size and -old - 1 >= top[-1][0]:
+            return
+        insort(top, (-old - 1, user_id))
+        del top[self.size:]
+
+    def add_member(self, chat_id, user_id):
+        counts = self.counts.get(chat_id)
+        if counts is not None and user_id not in counts:
+            counts[user_id] = 0
+            self.names[chat_id][user_id] = None
+            if len(self.tops[chat_id]) < self.size:
+                insort(self.tops[chat_id], (0, user_id))
+
+    def set_name(self, chat_id, user_id, name):
+        names = self.names.get(chat_id)
+        if names is not None:
+            names[user_id] = name
+            if user_id not in self.counts[chat_id]:
+                self.add_member(chat_id, user_id)
+
+    async def top(self, chat_id):
+        if chat_id not in self.tops:
+            if chat_id not in self.loading:
+                # Read on the writer right behind the flush, messages counted after it go to missed
+                self.missed[chat_id] = []
+                flushed = flush_counts()
+                rows = db.write(select_chat_counts, chat_id)
+                self.loading[chat_id] = asyncio.ensure_future(self.load(chat_id, flushed, rows))
+                self.loading[chat_id].add_done_callback(lambda _: self.loading.pop(chat_id, None))
+            try:
+                await asyncio.shield(self.loading[chat_id])
+            except Exception:
+                self.missed.pop(chat_id, None)
+                raise
+        names = self.names[chat_id]
+        return [(names.get(user_id), -count) for count, user_id in self.tops[chat_id]]
+
+leaderboard = Leaderboard()
+languages = {}
+
+# --- Activity ---
+COUNT_FLUSH_INTERVAL = int(os.environ.get("COUNT_FLUSH_INTERVAL", 5))
+ROLLUP_INTERVAL = int(os.environ.get("ROLLUP_INTERVAL", 300))
+HOURLY_RETENTION_DAYS = int(os.environ.get("HOURLY_RETENTION_DAYS", 7))
+DAILY_RETENTION_DAYS = max(int(os.environ.get("DAILY_RETENTION_DAYS", 90)), 62)  # Rollup of last month needs its days
+WINDOWS = ("day", "week", "month")
+
+# (chat_id, user_id, hour) -> [count, full_name], written to SQLite by flush_counts
+pending_counts = {}
+
+# --- Metrics ---
+METRICS_SAMPLES = 10000
+
+metrics = {"updates_received": 0, "updates_processed": 0, "flushes": 0, "rows_written": 0, "flush_seconds": 0.0}
+received_at = {}  # update_id -> perf_counter() when the webhook got it
+processing_lag = deque(maxlen=METRICS_SAMPLES)
+flush_latency = deque(maxlen=METRICS_SAMPLES)
+metrics_started = time.perf_counter()
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    result = {f"p{p}": ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in (50, 90, 95, 99)}
+    result["max"] = ordered[-1]
+    return {key: round(value * 1000, 3) for key, value in result.items()}
+
+def bucket_start(period, ts):
+    """Start of the UTC hour/day/week/month containing ts."""
+    ts = int(ts)
+    if period == "hour":
+        return ts - ts % 3600
+    day = ts - ts % 86400
+    if period == "day":
+        return day
+    if period == "week":
+        return day - (day // 86400 + 3) % 7 * 86400  # 1970-01-01 was a Thursday
+    month = datetime.fromtimestamp(ts, timezone.utc).replace(day=1, hour=0, minute=0, second=0)
+    return int(month.timestamp())
+
+def flush_counts():
+    """Hand the pending counters to the writer, the returned future resolves once committed."""
+    if not pending_counts:
+        return db.write(lambda conn: None)  # Still ordered after earlier flushes
+    batch = list(pending_counts.items())
+    pending_counts.clear()
+    return db.write(write_counts, batch)
+
+def write_counts(conn, batch):
+    started = time.perf_counter()
+    users = {}
+    for (chat_id, user_id, hour), (count, name) in batch:
+        users.setdefault((user_id, chat_id), [0, name])[0] += count
+    days = {}
+    for (chat_id, user_id, hour), (count, _) in batch:
+        key = (bucket_start("day", hour), chat_id, user_id)
+        days[key] = days.get(key, 0) + count
+    upsert = "INSERT INTO activity (period, bucket, chat_id, user_id, count) VALUES (?, ?, ?, ?, ?) ON CONFLICT (period, bucket, chat_id, user_id) DO UPDATE SET count = count + excluded.count"
+    conn.executemany("INSERT OR IGNORE INTO users (user_id, chat_id, username) VALUES (?, ?, ?)", [(u, c, name) for (u, c), (_, name) in users.items()])
+    conn.executemany("UPDATE users SET message_count = message_count + ? WHERE user_id=? AND chat_id=?", [(n, u, c) for (u, c), (n, _) in users.items()])
+    conn.executemany(upsert, [("hour", hour, c, u, n) for (c, u, hour), (n, _) in batch])
+    conn.executemany(upsert, [("day", day, c, u, n) for (day, c, u), n in days.items()])
+    conn.commit()
+    elapsed = time.perf_counter() - started
+    metrics["flushes"] += 1
+    metrics["rows_written"] += 2 * len(users) + len(batch) + len(days)
+    metrics["flush_seconds"] += elapsed
+    flush_latency.append(elapsed)
+
+def rollup_activity(conn, now=None):
+    """Rebuild the current and previous week/month from daily buckets, expire old ones."""
+    now = now or time.time()
+    ranges = []
+    for period in ("week", "month"):
+        current = bucket_start(period, now)
+        previous = bucket_start(period, current - 1)
+        following = current + 7 * 86400 if period == "week" else bucket_start(period, current + 32 * 86400)
+        ranges += [(period, previous, current), (period, current, following)]
+    for period, start, end in ranges:
+        conn.execute("DELETE FROM activity WHERE period=? AND bucket=?", (period, start))
+        conn.execute(
+            "INSERT INTO activity (period, bucket, chat_id, user_id, count) "
+            "SELECT ?, ?, chat_id, user_id, SUM(count) FROM activity "
+            "WHERE period='day' AND bucket>=? AND bucket<? GROUP BY chat_id, user_id",
+            (period, start, start, end)
+        )
+    conn.execute("DELETE FROM activity WHERE period='hour' AND bucket<?", (now - HOURLY_RETENTION_DAYS * 86400,))
+    conn.execute("DELETE FROM activity WHERE period='day' AND bucket<?", (now - DAILY_RETENTION_DAYS * 86400,))
+
+async def flush_counts_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await flush_counts()
+    except Exception as e:
+        logger.error(f"Ошибка записи счётчиков: {e}")
+
+async def rollup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await flush_counts()
+        await db.write(rollup_activity)
+    except Exception as e:
+        logger.error(f"Ошибка агрегации активности: {e}")
+
+# --- Broadcast ---
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))  # Telegram allows about 30 messages per second
+BROADCAST_PAGE = int(os.environ.get("BROADCAST_PAGE", 100))
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_ATTEMPTS = 3
+FIRST_CHAT_ID = -2 ** 63
+
+class TokenBucket:
+    """Hands out rate tokens per second with bursts up to capacity, shared by all senders."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # A flood wait is global for the bot, so every sender holds
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcasts = {}  # broadcast id -> live progress, also shown by /metrics
+broadcast_tasks = set()  # Cancelled on shutdown, the checkpoint lets the next start resume
+
+def start_broadcast(bot, broadcast_id):
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+async def send_broadcast_message(bot, chat_id, text):
+    # Each chat gets a single message, so only the global rate and flood waits matter
+    for _ in range(BROADCAST_ATTEMPTS):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return True
+        except RetryAfter as e:
+            broadcast_bucket.pause(e.retry_after)
+        except (Forbidden, BadRequest) as e:
+            logger.debug(f"Рассылка не доставлена в {chat_id}: {e}")
+            return False
+        except TelegramError as e:
+            logger.warning(f"Ошибка рассылки в {chat_id}: {e}")
+    return False
+
+def broadcast_text(progress, key):
+    lang = progress["lang"]
+    elapsed = max(time.monotonic() - progress["started"], 1e-9)
+    rate = round((progress["sent"] + progress["failed"] - progress["resumed_at"]) / elapsed, 1)
+    return messages[lang][key].format(rate=rate, **{k: progress[k] for k in ("id", "sent", "failed", "total")})
+
+async def report_broadcast(bot, progress, key="broadcast_progress"):
+    try:
+        await bot.edit_message_text(broadcast_text(progress, key), progress["admin_chat_id"], progress["message_id"])
+    except TelegramError as e:
+        logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+
+async def run_broadcast(bot, broadcast_id):
+    """Send page by page from the checkpoint, a restart resends at most the page in progress."""
+    admin_chat_id, text, last_chat_id, total, sent, failed = await db.fetchone(
+        "SELECT admin_chat_id, text, last_chat_id, total, sent, failed FROM broadcasts WHERE id=?", (broadcast_id,)
+    )
+    lang = await get_user_language(admin_chat_id, admin_chat_id)
+    progress = {
+        "id": broadcast_id, "admin_chat_id": admin_chat_id, "lang": lang, "total": total, "sent": sent, "failed": failed,
+        "resumed_at": sent + failed, "started": time.monotonic(), "cancelled": False,
+    }
+    broadcasts[broadcast_id] = progress
+    try:
+        message = await bot.send_message(admin_chat_id, broadcast_text(progress, "broadcast_progress"))
+        progress["message_id"] = message.message_id
+        reported = time.monotonic()
+        while not progress["cancelled"]:
+            page = await db.fetchall("SELECT DISTINCT chat_id FROM users WHERE chat_id>? ORDER BY chat_id LIMIT ?", (last_chat_id, BROADCAST_PAGE))
+            if not page:
+                break
+            results = await asyncio.gather(*(send_broadcast_message(bot, chat_id, text) for (chat_id,) in page))
+            progress["sent"] += sum(results)
+            progress["failed"] += len(results) - sum(results)
+            last_chat_id = page[-1][0]
+            await db.execute(("UPDATE broadcasts SET last_chat_id=?, sent=?, failed=? WHERE id=?", (last_chat_id, progress["sent"], progress["failed"], broadcast_id)))
+            if time.monotonic() - reported > BROADCAST_PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                await report_broadcast(bot, progress)
+        if progress["cancelled"]:
+            await report_broadcast(bot, progress, "broadcast_cancelled")
+        else:
+            await db.execute(("UPDATE broadcasts SET status='done' WHERE id=?", (broadcast_id,)))
+            await report_broadcast(bot, progress, "broadcast_done")
+    except Exception as e:
+        logger.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+    finally:
+        broadcasts.pop(broadcast_id, None)
+
+def create_broadcast(conn, admin_chat_id, text):
+    total = conn.execute("SELECT COUNT(DISTINCT chat_id) FROM users").fetchone()[0]
+    cur = conn.execute(
+        "INSERT INTO broadcasts (admin_chat_id, text, last_chat_id, total, created_at) VALUES (?, ?, ?, ?, ?)",
+        (admin_chat_id, text, FIRST_CHAT_ID, total, int(time.time()))
+    )
+    return cur.lastrowid
+
+def window_arg(context):
+    args = context.args or []
+    return args[0].lower() if args and args[0].lower() in WINDOWS else None
+
+async def get_user_language(user_id, chat_id):
+    if (user_id, chat_id) in languages:
+        return languages[(user_id, chat_id)]
+    row = await db.fetchone("SELECT language FROM users WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+    if row:
+        languages[(user_id, chat_id)] = row[0]
     return row[0] if row else "ru"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
+    lang = await get_user_language(user_id, chat_id)
     await update.message.reply_text(messages[lang]["start"])
 
 async def setname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = " ".join(context.args)
     user_id, chat_id = update.effective_user.id, update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
+    lang = await get_user_language(user_id, chat_id)
     if name:
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id))
-        cursor.execute("UPDATE users SET username=? WHERE user_id=? AND chat_id=?", (name, user_id, chat_id))
-        conn.commit()
+        await db.execute(
+            ("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id)),
+            ("UPDATE users SET username=? WHERE user_id=? AND chat_id=?", (name, user_id, chat_id)),
+        )
+        leaderboard.set_name(chat_id, user_id, name)
         await update.message.reply_text(f"✅ Имя обновлено: {name}")
     else:
         await update.message.reply_text(messages[lang]["name_hint"])
 
 async def delname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id, chat_id = update.effective_user.id, update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
-    cursor.execute("UPDATE users SET username=NULL WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-    conn.commit()
+    lang = await get_user_language(user_id, chat_id)
+    await db.execute(("UPDATE users SET username=NULL WHERE user_id=? AND chat_id=?", (user_id, chat_id)))
+    leaderboard.set_name(chat_id, user_id, None)
     await update.message.reply_text(messages[lang]["delname_done"])
 
 async def setdesc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     description = " ".join(context.args)
     user_id, chat_id = update.effective_user.id, update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
+    lang = await get_user_language(user_id, chat_id)
     if description:
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id))
-        cursor.execute("UPDATE users SET description=? WHERE user_id=? AND chat_id=?", (description, user_id, chat_id))
-        conn.commit()
+        await db.execute(
+            ("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id)),
+            ("UPDATE users SET description=? WHERE user_id=? AND chat_id=?", (description, user_id, chat_id)),
+        )
         await update.message.reply_text(f"✅ Описание обновлено: {description}")
     else:
         await update.message.reply_text(messages[lang]["desc_hint"])
 
 async def deldesc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id, chat_id = update.effective_user.id, update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
-    cursor.execute("UPDATE users SET description='' WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-    conn.commit()
+    lang = await get_user_language(user_id, chat_id)
+    await db.execute(("UPDATE users SET description='' WHERE user_id=? AND chat_id=?", (user_id, chat_id)))
     await update.message.reply_text(messages[lang]["deldesc_done"])
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id, chat_id = update.effective_user.id, update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
-    cursor.execute("SELECT username, message_count, description FROM users WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-    row = cursor.fetchone()
+    lang = await get_user_language(user_id, chat_id)
+    await flush_counts()
+    window = window_arg(context)
+    if window:
+        row = await db.fetchone("SELECT count FROM activity WHERE period=? AND bucket=? AND chat_id=? AND user_id=?", (window, bucket_start(window, time.time()), chat_id, user_id))
+        period = messages[lang]["periods"][window]
+        await update.effective_message.reply_text(messages[lang]["stats_window"].format(period=period, count=row[0] if row else 0))
+        return
+    row = await db.fetchone("SELECT username, message_count, description FROM users WHERE user_id=? AND chat_id=?", (user_id, chat_id))
     if row:
         name = row[0] or "не указано"
         count = row[1]
         desc = row[2] or "—"
-        await update.message.reply_text(messages[lang]["stats"].format(name=name, count=count, desc=desc))
+        await update.effective_message.reply_text(messages[lang]["stats"].format(name=name, count=count, desc=desc))
     else:
-        await update.message.reply_text(messages[lang]["no_data"])
+        await update.effective_message.reply_text(messages[lang]["no_data"])
 
 async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    lang = get_user_language(user_id, chat_id)
-    cursor.execute("SELECT username, message_count FROM users WHERE chat_id=? ORDER BY message_count DESC LIMIT 10", (chat_id,))
-    rows = cursor.fetchall()
+    lang = await get_user_language(user_id, chat_id)
+    window = window_arg(context)
+    if window:
+        await flush_counts()
+        rows = await db.fetchall(
+            "SELECT u.username, a.count FROM activity a LEFT JOIN users u ON u.user_id=a.user_id AND u.chat_id=a.chat_id "
+            "WHERE a.period=? AND a.bucket=? AND a.chat_id=? ORDER BY a.count DESC LIMIT ?",
+            (window, bucket_start(window, time.time()), chat_id, TOP_N)
+        )
+    else:
+        rows = await leaderboard.top(chat_id)
     if not rows:
-        await update.message.reply_text(messages[lang]["no_data"])
+        await update.effective_message.reply_text(messages[lang]["no_data"])
         return
     top_list = "\n".join([f"{i+1}. {u or '—'} — {c}" for i, (u, c) in enumerate(rows)])
-    await update.message.reply_text(messages[lang]["top"].format(top_list=top_list))
+    if window:
+        period = messages[lang]["periods"][window]
+        await update.effective_message.reply_text(messages[lang]["top_window"].format(period=period, top_list=top_list))
+    else:
+        await update.effective_message.reply_text(messages[lang]["top"].format(top_list=top_list))
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id, chat_id = update.effective_user.id, update.effective_chat.id
+    lang = await get_user_language(user_id, chat_id)
+    if not ADMIN_ID or str(user_id) != ADMIN_ID:
+        await update.message.reply_text(messages[lang]["only_admin"])
+        return
+    # Split off the command only, the text keeps its line breaks
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await update.message.reply_text(messages[lang]["broadcast_usage"])
+        return
+    if text.lower() == "cancel":
+        await db.execute(("UPDATE broadcasts SET status='cancelled' WHERE status='running'", ()))
+        for progress in broadcasts.values():
+            progress["cancelled"] = True
+        await update.message.reply_text(messages[lang]["broadcast_stopping"])
+        return
+    await flush_counts()
+    broadcast_id = await db.write(create_broadcast, chat_id, text)
+    # Runs in the background, the handler returns right away
+    start_broadcast(context.bot, broadcast_id)
 
 async def count_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # No awaits here, so concurrent updates are still counted in arrival order
     user = update.effective_user
     chat_id = update.effective_chat.id
-    cursor.execute("INSERT OR IGNORE INTO users (user_id, chat_id, username) VALUES (?, ?, ?)", (user.id, chat_id, user.full_name))
-    cursor.execute("UPDATE users SET message_count = message_count + 1 WHERE user_id=? AND chat_id=?", (user.id, chat_id))
-    conn.commit()
+    key = (chat_id, user.id, bucket_start("hour", time.time()))
+    pending = pending_counts.setdefault(key, [0, user.full_name])
+    pending[0] += 1
+    leaderboard.increment(chat_id, user.id, user.full_name)
+
+async def record_processed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs in the last handler group, after every other handler of this update
+    started = received_at.pop(update.update_id, None)
+    metrics["updates_processed"] += 1
+    if started is not None:
+        processing_lag.append(time.perf_counter() - started)
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id, chat_id = update.effective_user.id, update.effective_chat.id
-    lang = get_user_language(user_id, chat_id)
+    lang = await get_user_language(user_id, chat_id)
     keyboard = [
         [InlineKeyboardButton("📈 Моя статистика", callback_data="stats")],
         [InlineKeyboardButton("🏆 Топ", callback_data="top")],
@@ -168,7 +636,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id, chat_id = query.from_user.id, query.message.chat.id
-    lang = get_user_language(user_id, chat_id)
+    lang = await get_user_language(user_id, chat_id)
 
     if query.data == "stats":
         await stats(update, context)
@@ -184,30 +652,37 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await deldesc(update, context)
     elif query.data == "switch_lang":
         new_lang = "en" if lang == "ru" else "ru"
-        cursor.execute("UPDATE users SET language=? WHERE user_id=? AND chat_id=?", (new_lang, user_id, chat_id))
-        conn.commit()
+        await db.execute(("UPDATE users SET language=? WHERE user_id=? AND chat_id=?", (new_lang, user_id, chat_id)))
+        languages.pop((user_id, chat_id), None)
         await query.message.reply_text(messages[new_lang]["language_set"])
 
 async def greet_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for member in update.message.new_chat_members:
         chat_id = update.effective_chat.id
         user_id = member.id
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id))
-        lang = get_user_language(user_id, chat_id)
+        await db.execute(("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, chat_id)))
+        leaderboard.add_member(chat_id, user_id)
+        lang = await get_user_language(user_id, chat_id)
         keyboard = [[InlineKeyboardButton("🚀 Начать", callback_data="stats")]]
         msg = await update.message.reply_text(
             messages[lang]["welcome"].format(name=member.full_name),
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        await asyncio.sleep(30)
-        try:
-            await msg.delete()
-        except:
-            pass
+        # Deleted later by the job queue instead of holding the handler for 30 s
+        context.job_queue.run_once(delete_message, WELCOME_TTL, chat_id=chat_id, data=msg.message_id)
+
+async def delete_message(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await context.bot.delete_message(context.job.chat_id, context.job.data)
+    except Exception as e:
+        logger.debug(f"Не удалось удалить сообщение: {e}")
 
 # --- FastAPI + Webhook ---
 app = FastAPI()
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True)
+if BOT_API_URL:
+    builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot")
+application = builder.build()
 
 application.add_handler(CommandHandler("start", start))
 application.add_handler(CommandHandler("setname", setname))
@@ -217,9 +692,13 @@ application.add_handler(CommandHandler("deldesc", deldesc))
 application.add_handler(CommandHandler("stats", stats))
 application.add_handler(CommandHandler("top", top))
 application.add_handler(CommandHandler("menu", menu))
+application.add_handler(CommandHandler("broadcast", broadcast))
 application.add_handler(CallbackQueryHandler(handle_callback))
 application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, greet_user))
 application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), count_messages))
+application.add_handler(TypeHandler(Update, record_processed), group=1)
+application.job_queue.run_repeating(flush_counts_job, COUNT_FLUSH_INTERVAL)
+application.job_queue.run_repeating(rollup_job, ROLLUP_INTERVAL, first=10)
 
 @app.on_event("startup")
 async def on_startup():
@@ -227,16 +706,44 @@ async def on_startup():
     await application.start()
     await application.bot.set_webhook(f"{WEBHOOK_URL}/webhook")
     logger.info("Webhook установлен")
+    # Broadcasts interrupted by a restart continue from their checkpoint
+    for (broadcast_id,) in await db.fetchall("SELECT id FROM broadcasts WHERE status='running'"):
+        start_broadcast(application.bot, broadcast_id)
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    for task in list(broadcast_tasks):
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks, return_exceptions=True)
     await application.stop()
+    await flush_counts()
     await application.shutdown()
+    db.close()
     logger.info("Бот остановлен")
 
 @app.post("/webhook")
 async def webhook_handler(request: Request):
     json_update = await request.json()
     update = Update.de_json(json_update, application.bot)
+    metrics["updates_received"] += 1
+    if len(received_at) < METRICS_SAMPLES:
+        received_at[update.update_id] = time.perf_counter()
     await application.update_queue.put(update)
     return Response(status_code=200)
+
+@app.get("/metrics")
+async def metrics_handler():
+    uptime = time.perf_counter() - metrics_started
+    return {
+        **metrics,
+        "uptime_seconds": round(uptime, 3),
+        "update_queue_size": application.update_queue.qsize(),
+        "pending_counts": len(pending_counts),
+        "rows_per_second": round(metrics["rows_written"] / uptime, 3),
+        "processing_lag_ms": percentiles(processing_lag),
+        "flush_latency_ms": percentiles(flush_latency),
+        "broadcasts": {
+            broadcast_id: {key: progress[key] for key in ("sent", "failed", "total")}
+            for broadcast_id, progress in broadcasts.items()
+        },
+    }
@@ -1,9 +1,8 @@
+import asyncio
 import logging
 import os
 from typing import Tuple
 
-import google.generativeai as genai
-import openai
 from dotenv import load_dotenv
 from telethon import TelegramClient
 from telethon.errors.rpcerrorlist import UnauthorizedError
@@ -12,6 +11,7 @@ from src.handlers import (
     bard_chat_handler,
     bash_handler,
     bing_chat_handler,
+    cancel_handler,
     clear_handler,
     gemini_chat_handler,
     group_chat_handler,
@@ -21,14 +21,21 @@ from src.handlers import (
     switch_model_handler,
     user_chat_handler,
 )
+from src.utils import (
+    BotIdentity,
+    create_initial_folders,
+    current_bot,
+    lifecycle,
+    load_bots,
+    open_session,
+    Supervisor,
+    supervisors,
+)
 
 
 # Load  keys
 def load_keys() -> Tuple[str, int, str]:
     load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    openai.organization = os.getenv("OPENAI_ORG")
-    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
     api_id = os.getenv("API_ID")
     api_hash = os.getenv("API_HASH")
     bot_token = os.getenv("BOTTOKEN")
@@ -36,53 +43,78 @@ def load_keys() -> Tuple[str, int, str]:
 
 
 async def bot() -> None:
-    while True:
-        api_id, api_hash, bot_token = load_keys()
-        try:
-            client = await TelegramClient(None, api_id, api_hash).start(
-                bot_token=bot_token
-            )
-            logging.info("Successfully initiate bot")
-        except UnauthorizedError:
-            logging.error(
-                "Unauthorized access. Please check your Telethon API ID, API hash"
-            )
-            raise UnauthorizedError
-        except Exception as e:
-            logging.error(f"Error occurred: {e}")
-            raise e
-
-        client.add_event_handler(security_check)
-
-        # Search feature
-        client.add_event_handler(search_handler)
-        logging.debug("Search handler added")
-
-        # Terminal bash feature
-        client.add_event_handler(bash_handler)
-        logging.debug("Bash handler added")
-
-        # Clear chat history feature
-        client.add_event_handler(clear_handler)
-        logging.debug("Clear handler added")
-
-        # Switch gpt model
-        client.add_event_handler(switch_model_handler)
-        logging.debug("Switch model handler added")
-
-        # User and group chat
-        client.add_event_handler(bard_chat_handler)
-        logging.debug("Bard chat handler added")
-        client.add_event_handler(bing_chat_handler)
-        logging.debug("Bing chat handler added")
-        client.add_event_handler(gemini_chat_handler)
-        logging.debug("Gemini chat handler added")
-        client.add_event_handler(senpai_chat_handler)
-        logging.debug("Senpai chat handler added")
-        client.add_event_handler(group_chat_handler)
-        logging.debug("Group chat handler added")
-        client.add_event_handler(user_chat_handler)
-        logging.debug("User chat handler added")
-
-        print("Bot is running")
-        await client.run_until_disconnected()
+    # Every bot shares the providers, executors, tokenizer and store of this process
+    _, _, bot_token = load_keys()
+    await asyncio.gather(*(run_bot(identity) for identity in load_bots(bot_token)))
+
+
+async def run_bot(identity: BotIdentity) -> None:
+    # Tasks started from here, Telethon's update handling included, inherit the bot
+    current_bot.set(identity.name)
+    create_initial_folders(identity.name)
+    api_id, api_hash, _ = load_keys()
+    try:
+        # Reuse the auth key and entities of the previous run, no fresh login
+        session = open_session(identity.name)
+        client = await TelegramClient(session, api_id, api_hash).start(
+            bot_token=identity.token
+        )
+        identity.client = client
+        lifecycle.clients[identity.name] = client
+        logging.info(f"Successfully initiate bot {identity.name or 'default'}")
+    except UnauthorizedError:
+        logging.error(
+            "Unauthorized access. Please check your Telethon API ID, API hash"
+        )
+        raise UnauthorizedError
+    except Exception as e:
+        logging.error(f"Error occurred: {e}")
+        raise e
+
+    client.add_event_handler(security_check)
+
+    # Search feature
+    client.add_event_handler(search_handler)
+    logging.debug("Search handler added")
+
+    # Terminal bash feature
+    client.add_event_handler(bash_handler)
+    client.add_event_handler(cancel_handler)
+    logging.debug("Bash handler added")
+
+    # Clear chat history feature
+    client.add_event_handler(clear_handler)
+    logging.debug("Clear handler added")
+
+    # Switch gpt model
+    client.add_event_handler(switch_model_handler)
+    logging.debug("Switch model handler added")
+
+    # User and group chat
+    client.add_event_handler(bard_chat_handler)
+    logging.debug("Bard chat handler added")
+    client.add_event_handler(bing_chat_handler)
+    logging.debug("Bing chat handler added")
+    client.add_event_handler(gemini_chat_handler)
+    logging.debug("Gemini chat handler added")
+    client.add_event_handler(senpai_chat_handler)
+    logging.debug("Senpai chat handler added")
+    client.add_event_handler(group_chat_handler)
+    logging.debug("Group chat handler added")
+    client.add_event_handler(user_chat_handler)
+    logging.debug("User chat handler added")
+
+    # Messages the previous instance could not finish before shutting down
+    await lifecycle.replay_pending(client)
+
+    # Updates sent while the bot was down, now that the handlers are in place
+    try:
+        await client.catch_up()
+    except Exception as e:
+        logging.error(f"Error occurred while catching up: {e}")
+
+    print("Bot is running")
+    # Reconnects reuse this client and its handlers until the app shuts down
+    supervisor = Supervisor(identity.name, client, identity.token)
+    supervisors[identity.name] = supervisor
+    await supervisor.run()
@@ -1,57 +1,213 @@
 import asyncio
+import codecs
 import io
-import json
 import logging
+import os
+import signal
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
 
-import openai
-from duckduckgo_search import ddg
+from src.functions.search_func import summarize_search
 from src.utils import (
-    LOG_PATH,
-    VIETNAMESE_WORDS,
-    num_tokens_from_messages,
+    Message,
+    coalesce,
+    index_turns,
     read_existing_conversation,
+    save_conversation,
 )
+from telethon.errors import RPCError
 from telethon.events import NewMessage
-from unidecode import unidecode
+
+BASH_TIMEOUT = float(os.getenv("BASH_TIMEOUT", 300))
+BASH_MAX_OUTPUT = int(os.getenv("BASH_MAX_OUTPUT", 10 * 1024 * 1024))
+BASH_BUFFER_SIZE = int(os.getenv("BASH_BUFFER_SIZE", 64 * 1024))
+BASH_EDIT_INTERVAL = float(os.getenv("BASH_EDIT_INTERVAL", 2))
+MESSAGE_LIMIT = 4095
+
+# None while the command is starting, the chat is taken all the same
+running_commands: Dict[int, Optional[asyncio.subprocess.Process]] = {}
+cancelled_commands: Set[int] = set()
 
 # Functions for bot operation
 
 
+class RingBuffer:
+    """Keeps only the last `size` characters of a command's output."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.chunks: Deque[str] = deque()
+        self.length = 0
+        self.dropped = 0
+
+    def append(self, text: str) -> None:
+        self.chunks.append(text)
+        self.length += len(text)
+        while self.length > self.size:
+            extra = self.length - self.size
+            head = self.chunks[0]
+            if len(head) <= extra:
+                self.chunks.popleft()
+                extra = len(head)
+            else:
+                self.chunks[0] = head[extra:]
+            self.length -= extra
+            self.dropped += extra
+
+    def getvalue(self) -> str:
+        return "".join(self.chunks)
+
+
+def kill_process_group(process: asyncio.subprocess.Process) -> None:
+    # The shell runs in its own session, so this also gets its children
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def cancel_bash(chat_id: int) -> bool:
+    if chat_id not in running_commands:
+        return False
+    process = running_commands[chat_id]
+    if process is not None and process.returncode is not None:
+        return False
+    # A command still starting is killed by bash() as soon as it has a process
+    cancelled_commands.add(chat_id)
+    if process is not None:
+        kill_process_group(process)
+    return True
+
+
+def format_bash_output(
+    cmd: str, pid: int, status: str, buffer: RingBuffer
+) -> Tuple[str, bool]:
+    """The message text and whether it only shows the tail of the output."""
+    header = (
+        f"**     QUERY:**\n  __Command:__` {cmd}` \n  __PID:__` {pid}`"
+        f"\n**STATUS:** __{status}__"
+        f"\n**OUTPUT:**\n"
+    )
+    room = MESSAGE_LIMIT - len(header) - len("```\n…\n```")
+    output = buffer.getvalue()
+    if not output and not buffer.dropped:
+        return header + "`No output`", False
+    truncated = len(output) > room or buffer.dropped > 0
+    if truncated:
+        output = "…" + output[-room:]
+    return header + f"```\n{output}\n```", truncated
+
+
+async def stream_output(
+    process: asyncio.subprocess.Process, buffer: RingBuffer
+) -> bool:
+    """Read the output as it comes, False once it went over BASH_MAX_OUTPUT."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    total = 0
+    while True:
+        chunk = await process.stdout.read(4096)
+        if not chunk:
+            break
+        total += len(chunk)
+        buffer.append(decoder.decode(chunk))
+        if total > BASH_MAX_OUTPUT:
+            kill_process_group(process)
+            return False
+    buffer.append(decoder.decode(b"", final=True))
+    return True
+
+
+async def edit_output(message, text: str) -> None:
+    # A failed edit (flood wait, not modified) must not take the command down
+    try:
+        await message.edit(text)
+    except (RPCError, ConnectionError) as e:
+        logging.warning(f"Error occurred while editing /bash output: {e}")
+
+
 async def bash(event: NewMessage) -> str:
+    """Run the command, editing one message with its output while it runs."""
+    client = event.client
+    chat_id = event.chat_id
     try:
         cmd = event.text.split(" ", maxsplit=1)[1]
+    except IndexError:
+        OUTPUT = "**Usage:** `/bash {command}`"
+        await client.send_message(chat_id, OUTPUT)
+        return OUTPUT
+    if chat_id in running_commands:
+        OUTPUT = "A command is still running here, /cancel it first"
+        await client.send_message(chat_id, OUTPUT)
+        return OUTPUT
+    # Taken before the first await, so a second /bash cannot slip in
+    running_commands[chat_id] = None
+    process = None
+    OUTPUT = ""
+    try:
         process = await asyncio.create_subprocess_shell(
-            cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
         )
-        stdout, stderr = await process.communicate()
-        e = stderr.decode()
-        if not e:
-            e = "No Error"
-        o = stdout.decode()
-        if not o:
-            o = "**TIP**: \n`If you want to see the results of your code, I suggest printing them to stdout.`"
-        else:
-            _o = [f"`  {x}`" for x in o.split("\n")]
-            o = "\n".join(_o)
-        OUTPUT = (
-            f"**     QUERY:**\n  __Command:__` {cmd}` \n  __PID:__` {process.pid}`"
-            f"\n**ERROR:** \n`  {e}`"
-            f"\n**OUTPUT:**\n{o}"
-        )
-        if len(OUTPUT) > 4095:
-            with io.BytesIO(str.encode(OUTPUT)) as out_file:
+        running_commands[chat_id] = process
+        if chat_id in cancelled_commands:
+            kill_process_group(process)
+        logging.debug("Bash initiated")
+        buffer = RingBuffer(BASH_BUFFER_SIZE)
+        OUTPUT, _ = format_bash_output(cmd, process.pid, "running", buffer)
+        message = await client.send_message(chat_id, OUTPUT)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + BASH_TIMEOUT
+        reader = asyncio.create_task(stream_output(process, buffer))
+        status = None
+        while True:
+            timeout = min(BASH_EDIT_INTERVAL, deadline - loop.time())
+            await asyncio.wait({reader}, timeout=max(timeout, 0))
+            if reader.done():
+                break
+            if loop.time() >= deadline:
+                status = f"killed after {BASH_TIMEOUT:g}s"
+                kill_process_group(process)
+                break
+            # Throttled so a chatty command does not hit the edit flood limit
+            text, _ = format_bash_output(cmd, process.pid, "running", buffer)
+            if text != OUTPUT:
+                OUTPUT = text
+                await edit_output(message, OUTPUT)
+        try:
+            within_limit = await asyncio.wait_for(reader, 5)
+        except asyncio.TimeoutError:
+            # A child outside the process group may keep the pipe open
+            within_limit = True
+        returncode = await process.wait()
+        if chat_id in cancelled_commands:
+            status = "cancelled"
+        elif not within_limit:
+            status = f"killed after {BASH_MAX_OUTPUT} bytes of output"
+        status = status or f"exited with code {returncode}"
+        text, truncated = format_bash_output(cmd, process.pid, status, buffer)
+        if text != OUTPUT:
+            OUTPUT = text
+            await edit_output(message, OUTPUT)
+        if truncated:
+            # The message only shows the tail, send what the buffer kept as a file
+            with io.BytesIO(str.encode(buffer.getvalue())) as out_file:
                 out_file.name = "exec.text"
-                await event.client.send_file(
-                    event.chat_id,
+                await client.send_file(
+                    chat_id,
                     out_file,
                     force_document=True,
                     allow_cache=False,
                     caption=cmd,
                 )
-                await event.delete()
-        logging.debug("Bash initiated")
     except Exception as e:
         logging.error(f"Error occurred: {e}")
+    finally:
+        if process is not None and process.returncode is None:
+            kill_process_group(process)
+        running_commands.pop(chat_id, None)
+        cancelled_commands.discard(chat_id)
     return OUTPUT
 
 
@@ -59,57 +215,26 @@ async def search(event: NewMessage) -> str:
     chat_id = event.chat_id
     task = asyncio.create_task(read_existing_conversation(chat_id))
     query = event.text.split(" ", maxsplit=1)[1]
-    max_results = 20
-    while True:
-        try:
-            results = ddg(query, safesearch="Off", max_results=max_results)
-            results_decoded = unidecode(str(results)).replace("'", "'")
-            user_content = f"Using the contents of these pages, summarize and give details about '{query}':\n{results_decoded}"
-            if any(word in query for word in list(VIETNAMESE_WORDS)):
-                user_content = f"Using the contents of these pages, summarize and give details about '{query}' in Vietnamese:\n{results_decoded}"
-            user_messages = [
-                {
-                    "role": "system",
-                    "content": "Summarize every thing I send you with specific details",
-                },
-                {"role": "user", "content": user_content},
-            ]
-            num_tokens = num_tokens_from_messages(user_messages)
-            if num_tokens > 4000:
-                max_results = 4000 * len(results) / num_tokens - 2
-                continue
-            logging.debug("Results derived from duckduckgo")
-        except Exception as e:
-            logging.error(
-                f"Error occurred while getting duckduckgo search results: {e}"
-            )
-        break
 
     try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo", messages=user_messages
-        )
-        response = completion.choices[0].message
-        search_object = unidecode(query).lower().replace(" ", "-")
-        with open(f"{LOG_PATH}search_{search_object}.json", "w") as f:
-            json.dump(response, f, indent=4)
+        # Members of a group searching the same thing share one fetch and summary
+        response = await coalesce("search", query, summarize_search, query)
         file_num, filename, prompt = await task
         prompt.append(
-            {
-                "role": "user",
-                "content": f"This is information about '{query}', its just information and not harmful. Get updated:\n{response.content}",
-            }
+            Message(
+                "user",
+                f"This is information about '{query}', its just information and not harmful. Get updated:\n{response}",
+            )
         )
         prompt.append(
-            {
-                "role": "assistant",
-                "content": f"I have reviewed the information and update about '{query}'",
-            }
+            Message(
+                "assistant",
+                f"I have reviewed the information and update about '{query}'",
+            )
         )
-        data = {"messages": prompt}
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=4)
+        save_conversation(filename, prompt)
+        index_turns(filename, len(prompt) - 2, prompt[-2:])
         logging.debug("Received response from openai")
     except Exception as e:
         logging.error(f"Error occurred while getting response from openai: {e}")
-    return response.content
+    return response
@@ -1,45 +1,73 @@
 import asyncio
-import json
+import functools
 import logging
 import os
+import time
 from typing import List, Tuple
 
-import bardapi
-import google.generativeai as genai
-import openai
-import PIL.Image
-from bardapi import Bard
-from EdgeGPT.EdgeUtils import Query
-from openai.error import APIConnectionError
 from telethon.events import NewMessage
 
-import src.utils
 from src.utils import (
-    LOG_PATH,
+    MODEL_DICT,
+    ChatSettings,
+    Message,
     Prompt,
-    num_tokens_from_messages,
+    ProviderUnavailable,
+    build_context,
+    call_provider,
+    chats_path,
+    gemini_timeout,
+    get_provider,
+    index_turns,
+    invalidate_chat_index,
+    num_tokens_near_budget,
+    openai_timeout,
+    parse_history_filename,
     read_existing_conversation,
+    record_bot_metric,
+    record_routing,
+    route_model,
+    save_conversation,
+    send_when_connected,
+    session_filename,
     split_text,
+    strip_persona_prefix,
+    to_api,
+    update_session_file,
 )
 
 
 async def over_token(
-    num_tokens: int, event: NewMessage, prompt: Prompt, filename: str
+    num_tokens: int,
+    event: NewMessage,
+    prompt: Prompt,
+    filename: str,
+    settings: ChatSettings,
 ) -> None:
-    MAX_TOKEN = src.utils.utils.max_token
-    SYS_MESS = src.utils.utils.sys_mess
-    MODEL = src.utils.utils.model
+    MAX_TOKEN = settings.max_token
+    openai = get_provider("openai")
     try:
         await event.reply(
             f"**Reach {num_tokens} tokens**, exceeds {MAX_TOKEN}, creating new chat"
         )
-        prompt.append({"role": "user", "content": "summarize this conversation"})
-        completion = openai.ChatCompletion.create(model=MODEL, messages=prompt)
+        messages = settings.persona.messages + prompt
+        messages.append(Message("user", "summarize this conversation"))
+        decision = route_model(messages, pinned=settings.model_key)
+        loop = asyncio.get_event_loop()
+        completion = await loop.run_in_executor(
+            None,
+            functools.partial(
+                call_provider,
+                "openai",
+                openai.ChatCompletion.create,
+                model=MODEL_DICT[decision["model_key"]][0],
+                messages=to_api(messages),
+                timeout_kwargs=openai_timeout,
+            ),
+        )
         response = completion.choices[0].message.content
-        data = {"messages": SYS_MESS}
-        data["messages"].append({"role": "system", "content": response})
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=4)
+        save_conversation(filename, [Message("system", response)])
+        invalidate_chat_index(parse_history_filename(filename)[0])
         logging.debug(f"Successfully handle overtoken")
     except Exception as e:
         logging.error(f"Error occurred: {e}")
@@ -47,18 +75,21 @@ async def over_token(
 
 
 async def start_and_check(
-    event: NewMessage, message: str, chat_id: int
+    event: NewMessage, message: str, chat_id: int, settings: ChatSettings
 ) -> Tuple[str, Prompt]:
-    MAX_TOKEN = src.utils.utils.max_token
+    MAX_TOKEN = settings.max_token
+    # The persona prefix is counted once and reused for every request
+    PREFIX_TOKENS = settings.persona.num_tokens
     try:
-        if not os.path.exists(f"{LOG_PATH}chats/session/{chat_id}.json"):
-            data = {"session": 1}
-            with open(f"{LOG_PATH}chats/session/{chat_id}.json", "w") as f:
-                json.dump(data, f)
+        if not os.path.exists(session_filename(chat_id)):
+            update_session_file(chat_id, session=1)
         while True:
             file_num, filename, prompt = await read_existing_conversation(chat_id)
-            prompt.append({"role": "user", "content": message})
-            num_tokens = num_tokens_from_messages(prompt)
+            prompt = strip_persona_prefix(prompt)
+            prompt.append(Message("user", message))
+            num_tokens = PREFIX_TOKENS + num_tokens_near_budget(
+                prompt, MAX_TOKEN - PREFIX_TOKENS
+            )
             if num_tokens > MAX_TOKEN:  # Cant summarize old chats
                 logging.warn(
                     f"Number of tokens exceeds {MAX_TOKEN} limit, creating new chat"
@@ -67,19 +98,22 @@ async def start_and_check(
                 await event.reply(
                     f"**Reach {num_tokens} tokens**, exceeds {MAX_TOKEN}, clear old chat, creating new chat"
                 )
-                data = {"session": file_num}
-                with open(f"{LOG_PATH}chats/session/{chat_id}.json", "w") as f:
-                    json.dump(data, f)
+                update_session_file(chat_id, session=file_num)
                 continue
             elif num_tokens > MAX_TOKEN - 17:  # Summarize old chats
                 logging.warn(
                     f"Number of tokens nearly exceeds {MAX_TOKEN} limit, summarizing old chats"
                 )
                 file_num += 1
-                data = {"session": file_num}
-                with open(f"{LOG_PATH}chats/session/{chat_id}.json", "w") as f:
-                    json.dump(data, f)
-                await over_token(num_tokens, event, prompt, filename)
+                update_session_file(chat_id, session=file_num)
+                # The summary opens the new session, the old one is kept as is
+                await over_token(
+                    num_tokens,
+                    event,
+                    prompt[:-1],
+                    f"{chats_path()}history/{chat_id}_{file_num}.json",
+                    settings,
+                )
                 continue
             else:
                 break
@@ -89,34 +123,61 @@ async def start_and_check(
     return filename, prompt
 
 
-def get_openai_response(prompt: Prompt, filename: str) -> str:
-    MAX_TOKEN = src.utils.utils.max_token
-    MODEL = src.utils.utils.model
-    trial = 0
-    while trial < 5:
-        try:
-            completion = openai.ChatCompletion.create(model=MODEL, messages=prompt)
-            result = completion.choices[0].message
-            num_tokens_left = MAX_TOKEN - completion.usage.total_tokens
-            responses = f"{result.content}\n\n__({num_tokens_left} tokens left)__"
-            prompt.append(result)
-            data = {"messages": prompt}
-            with open(filename, "w") as f:
-                json.dump(data, f, indent=4)
-            logging.debug("Received response from openai")
-            trial = 5
-        except APIConnectionError:
-            responses = "🔌 Render and OpenAI hate each other"
-            logging.error(f"API Connection failed: {e}")
-            trial += 1
-        except Exception as e:
-            responses = "💩 OpenAI is being stupid, please try again "
-            logging.error(f"Error occurred while getting response from openai: {e}")
+def get_openai_response(prompt: Prompt, filename: str, settings: ChatSettings) -> str:
+    openai = get_provider("openai")
+    # Only the relevant older turns and the recent window are sent, the session
+    # file still keeps every turn
+    try:
+        context = build_context(filename, prompt)
+    except Exception as e:
+        logging.error(f"Error occurred while building context: {e}")
+        context = prompt
+    # The cheapest model that fits this request, recorded for cost and latency
+    decision = route_model(
+        context, settings.persona.num_tokens, pinned=settings.model_key
+    )
+    # Tokens left are those of the model that answers, not of the largest one
+    MODEL, MAX_TOKEN = MODEL_DICT[decision["model_key"]]
+    context = settings.persona.messages + context
+    chat_id = parse_history_filename(filename)[0]
+    try:
+        start = time.perf_counter()
+        completion = call_provider(
+            "openai",
+            openai.ChatCompletion.create,
+            model=MODEL,
+            messages=to_api(context),
+            timeout_kwargs=openai_timeout,
+        )
+        record_routing(
+            decision,
+            chat_id,
+            time.perf_counter() - start,
+            completion.usage.total_tokens,
+        )
+        result = completion.choices[0].message
+        num_tokens_left = MAX_TOKEN - completion.usage.total_tokens
+        responses = f"{result.content}\n\n__({num_tokens_left} tokens left)__"
+        # Only role and content are kept, not the whole response object
+        prompt.append(Message.from_dict(result))
+        save_conversation(filename, prompt)
+        index_turns(filename, len(prompt) - 2, prompt[-2:])
+        logging.debug("Received response from openai")
+    except ProviderUnavailable as e:
+        responses = "🔌 OpenAI is down right now, please try again in a minute"
+        logging.error(f"Skipped openai request: {e}")
+    except openai.error.APIConnectionError as e:
+        responses = "🔌 Render and OpenAI hate each other"
+        logging.error(f"API Connection failed: {e}")
+    except Exception as e:
+        responses = "💩 OpenAI is being stupid, please try again "
+        logging.error(f"Error occurred while getting response from openai: {e}")
     return responses
 
 
 def get_bard_response(input_text: str) -> str:
     try:
+        bardapi = get_provider("bard")
         if input_text.startswith("/timeout"):
             split_text = input_text.split(maxsplit=2)
             try:
@@ -126,15 +187,28 @@ def get_bard_response(input_text: str) -> str:
                 return "Incorrect time input! Correct input should follow: **/bard /timeout {number}**. For example: /bard /timeout 120"
         else:
             timeout = 60
-        try:
-            responses = Bard(token_from_browser=True).get_answer(input_text)
-            logging.debug("Received response from bard by token_from_browser")
-        except:
-            # Send an API request and get a response.
-            responses = bardapi.core.Bard(timeout=timeout).get_answer(input_text)[
-                "content"
-            ]
-            logging.debug("Received response from bard by token")
+
+        def ask_bard(attempt_timeout: float) -> str:
+            attempt_timeout = min(timeout, attempt_timeout)
+            try:
+                responses = bardapi.Bard(
+                    token_from_browser=True, timeout=attempt_timeout
+                ).get_answer(input_text)
+                logging.debug("Received response from bard by token_from_browser")
+            except:
+                # Send an API request and get a response.
+                responses = bardapi.core.Bard(timeout=attempt_timeout).get_answer(
+                    input_text
+                )["content"]
+                logging.debug("Received response from bard by token")
+            return responses
+
+        responses = call_provider(
+            "bard", ask_bard, timeout_kwargs=lambda t: {"attempt_timeout": t}
+        )
+    except ProviderUnavailable as e:
+        responses = "🤯 Bard is down right now, please try again later"
+        logging.error(f"Skipped bard request: {e}")
     except Exception as e:
         responses = "🤯 Bard is under construction, dont use it for now "
         logging.error(f"Error occurred while getting response from bard: {e}")
@@ -143,8 +217,11 @@ def get_bard_response(input_text: str) -> str:
 
 def get_gemini_response(input_text: str) -> str:
     try:
+        genai = get_provider("gemini")
         model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(
+        response = call_provider(
+            "gemini",
+            model.generate_content,
             input_text,
             safety_settings=[
                 {
@@ -164,8 +241,12 @@ def get_gemini_response(input_text: str) -> str:
                     "threshold": "BLOCK_NONE",
                 },
             ],
+            timeout_kwargs=gemini_timeout,
         )
         responses = response.text
+    except ProviderUnavailable as e:
+        responses = "💩 Gemini is down right now, please try again in a minute"
+        logging.error(f"Skipped gemini request: {e}")
     except Exception as e:
         responses = "💩 Gemini is being stupid, please try again "
         logging.error(f"Error occurred while getting response from gemini: {e}")
@@ -174,10 +255,13 @@ def get_gemini_response(input_text: str) -> str:
 
 def get_gemini_vison_response(input_text: str, img_path: str) -> str:
     try:
-        img = PIL.Image.open(img_path)
+        img = get_provider("pil").open(img_path)
         try:
+            genai = get_provider("gemini")
             model = genai.GenerativeModel("gemini-1.5-flash")
-            response = model.generate_content(
+            response = call_provider(
+                "gemini",
+                model.generate_content,
                 [
                     input_text,
                     img,
@@ -200,6 +284,7 @@ def get_gemini_vison_response(input_text: str, img_path: str) -> str:
                         "threshold": "BLOCK_NONE",
                     },
                 ],
+                timeout_kwargs=gemini_timeout,
             )
             response.resolve()
             responses = response.text
@@ -215,7 +300,7 @@ def get_gemini_vison_response(input_text: str, img_path: str) -> str:
 def get_bing_response(input_text):
     try:
         COOKIE_PATH = os.getenv("COOKIE_PATH")
-        q = Query(
+        q = get_provider("bing").Query(
             input_text,
             style="creative",  # or: 'balanced', 'precise'
             cookie_file=COOKIE_PATH,
@@ -245,20 +330,21 @@ def get_bing_response(input_text):
 
 
 async def process_and_send_mess(event, text: str, limit=500) -> None:
+    record_bot_metric("replies")
     text_lst = text.split("```")
     cur_limit = 4096
     for idx, text in enumerate(text_lst):
         if idx % 2 == 0:
             mess_gen = split_text(text, cur_limit)
             for mess in mess_gen:
-                await event.client.send_message(
-                    event.chat_id, mess, background=True, silent=True
+                await send_when_connected(
+                    event.client, event.chat_id, mess, background=True, silent=True
                 )
                 await asyncio.sleep(1)
         else:
             mess_gen = split_text(text, cur_limit, prefix="```\n", sulfix="\n```")
             for mess in mess_gen:
-                await event.client.send_message(
-                    event.chat_id, mess, background=True, silent=True
+                await send_when_connected(
+                    event.client, event.chat_id, mess, background=True, silent=True
                 )
                 await asyncio.sleep(1)
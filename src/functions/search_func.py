@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import re
+from typing import Callable, List, Set
+
+from unidecode import unidecode
+
+from src.utils import (
+    LOG_PATH,
+    VIETNAMESE_WORDS,
+    Prompt,
+    call_provider,
+    get_provider,
+    num_tokens_from_messages,
+    num_tokens_from_text,
+    openai_timeout,
+)
+
+# A search source takes (query, max_results) and returns hits shaped like ddg's:
+# {"title": ..., "body": ..., "href": ...}
+SearchSource = Callable[[str, int], List[dict]]
+
+SEARCH_TOKEN_BUDGET = 4000
+SEARCH_MAX_RESULTS = 20
+DUPLICATE_THRESHOLD = 0.8
+
+
+def ddg_source(query: str, max_results: int) -> List[dict]:
+    return (
+        get_provider("ddg").ddg(query, safesearch="Off", max_results=max_results) or []
+    )
+
+
+search_source: SearchSource = ddg_source
+
+
+def set_search_source(source: SearchSource) -> None:
+    global search_source
+    search_source = source
+
+
+def hit_to_text(hit: dict) -> str:
+    title = hit.get("title") or ""
+    body = hit.get("body") or ""
+    href = hit.get("href") or ""
+    text = re.sub(r"\s+", " ", f"{title}: {body} ({href})").strip()
+    return unidecode(text)
+
+
+def shingles(text: str, size: int = 3) -> Set[tuple]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def deduplicate_hits(texts: List[str]) -> List[str]:
+    kept, kept_shingles = [], []
+    for text in texts:
+        current = shingles(text)
+        duplicate = any(
+            len(current & other) / max(len(current | other), 1) >= DUPLICATE_THRESHOLD
+            for other in kept_shingles
+        )
+        if not duplicate:
+            kept.append(text)
+            kept_shingles.append(current)
+    return kept
+
+
+def pack_search_messages(
+    query: str, texts: List[str], budget: int = SEARCH_TOKEN_BUDGET
+) -> Prompt:
+    user_content = f"Using the contents of these pages, summarize and give details about '{query}':\n"
+    if any(word in query for word in VIETNAMESE_WORDS):
+        user_content = f"Using the contents of these pages, summarize and give details about '{query}' in Vietnamese:\n"
+    user_messages = [
+        {
+            "role": "system",
+            "content": "Summarize every thing I send you with specific details",
+        },
+        {"role": "user", "content": user_content},
+    ]
+    # Hits are ranked by the engine, keep taking them in order while they fit
+    num_tokens = num_tokens_from_messages(user_messages)
+    packed = []
+    for text in texts:
+        hit_tokens = num_tokens_from_text(f"{text}\n")
+        if num_tokens + hit_tokens > budget:
+            continue
+        packed.append(text)
+        num_tokens += hit_tokens
+    user_messages[1]["content"] += "\n".join(packed)
+    logging.debug(f"Packed {len(packed)}/{len(texts)} hits in {num_tokens} tokens")
+    return user_messages
+
+
+async def build_search_messages(
+    query: str,
+    budget: int = SEARCH_TOKEN_BUDGET,
+    max_results: int = SEARCH_MAX_RESULTS,
+) -> Prompt:
+    loop = asyncio.get_event_loop()
+    try:
+        hits = await loop.run_in_executor(None, search_source, query, max_results)
+        logging.debug("Results derived from search source")
+    except Exception as e:
+        logging.error(f"Error occurred while getting search results: {e}")
+        hits = []
+    texts = deduplicate_hits([hit_to_text(hit) for hit in hits])
+    return pack_search_messages(query, texts, budget)
+
+
+def get_search_summary(user_messages: Prompt) -> dict:
+    openai = get_provider("openai")
+    completion = call_provider(
+        "openai",
+        openai.ChatCompletion.create,
+        model="gpt-3.5-turbo",
+        messages=user_messages,
+        timeout_kwargs=openai_timeout,
+    )
+    return completion.choices[0].message
+
+
+async def summarize_search(query: str) -> str:
+    user_messages = await build_search_messages(query)
+    loop = asyncio.get_event_loop()
+    response = await loop.run_in_executor(None, get_search_summary, user_messages)
+    search_object = unidecode(query).lower().replace(" ", "-")
+    with open(f"{LOG_PATH}search_{search_object}.json", "w") as f:
+        json.dump(response, f, indent=4)
+    return response.content
@@ -8,8 +8,7 @@ from telethon.tl.custom import Button
 from telethon.tl.functions.messages import SetTypingRequest
 from telethon.tl.types import SendMessageTypingAction
 
-import src.utils.utils
-from src.functions.additional_func import bash, search
+from src.functions.additional_func import bash, cancel_bash, search
 from src.functions.chat_func import (
     get_bard_response,
     get_bing_response,
@@ -20,29 +19,57 @@ from src.functions.chat_func import (
     start_and_check,
 )
 from src.utils import (
-    ALLOW_USERS,
     LOG_PATH,
-    MODEL_DICT,
     RANDOM_ACTION,
-    SYS_MESS_FRIENDLY,
-    SYS_MESS_SENPAI,
+    admission,
     check_chat_type,
+    coalesce,
+    current_bot,
+    default_persona,
+    delete_chat_history,
+    get_chat_settings,
+    identity_of,
+    lifecycle,
+    model_name,
+    record_bot_metric,
+    routable_models,
+    update_chat_settings,
 )
 
 
 @register(NewMessage())
 async def security_check(event: NewMessage) -> None:
     chat_id = event.chat_id
-    if chat_id not in ALLOW_USERS:
-        client = event.client
-        await client.send_message(
-            chat_id, f"This is personal property, you are not allowed to proceed!"
-        )
-        raise StopPropagation
+    # Later handlers of this update run in the same task and see this bot
+    identity = identity_of(event.client)
+    if identity is not None:
+        current_bot.set(identity.name)
+    record_bot_metric("received")
+    lifecycle.track(event)  # Stops here while the app is shutting down
+    reply = admission.check(
+        chat_id, identity.allow_users if identity is not None else None
+    )
+    if reply is not None:
+        await refuse(event, reply)
+
+
+async def refuse(event: NewMessage, reply: str) -> None:
+    record_bot_metric("refused")
+    if admission.should_reply(event.chat_id):
+        await event.client.send_message(event.chat_id, reply)
+    raise StopPropagation
+
+
+async def charge_request(event: NewMessage) -> None:
+    # Group chatter is not charged, only the updates the bot is about to answer
+    reply = admission.charge(event.chat_id, event.sender_id, event.raw_text)
+    if reply is not None:
+        await refuse(event, reply)
 
 
 @register(NewMessage(pattern="/search"))
 async def search_handler(event: NewMessage) -> None:
+    await charge_request(event)
     client = event.client
     chat_id = event.chat_id
     await client(SetTypingRequest(peer=chat_id, action=SendMessageTypingAction()))
@@ -59,31 +86,43 @@ async def search_handler(event: NewMessage) -> None:
 
 @register(NewMessage(pattern="/bash"))
 async def bash_handler(event: NewMessage) -> None:
-    client = event.client
+    await charge_request(event)
+    # bash() answers in the chat itself and keeps editing its message while it runs
     response = await bash(event)
+    logging.debug(f"Ran /bash in {event.chat_id}: {response[:80]}")
+    raise StopPropagation
+
+
+@register(NewMessage(pattern="/cancel"))
+async def cancel_handler(event: NewMessage) -> None:
+    client = event.client
     try:
-        await client.send_message(event.chat_id, f"{response}")
-        logging.debug(f"Sent /bash to {event.chat_id}")
+        if cancel_bash(event.chat_id):
+            await client.send_message(event.chat_id, "**Command cancelled**")
+        else:
+            await client.send_message(event.chat_id, "Nothing to cancel")
     except Exception as e:
-        logging.error(f"Error occurred while responding /bash cmd: {e}")
+        logging.error(f"Error occurred while responding /cancel cmd: {e}")
     raise StopPropagation
 
 
 @register(NewMessage(pattern="/clear"))
 async def clear_handler(event: NewMessage) -> None:
     client = event.client
-    event.text = f"/bash rm {LOG_PATH}chats/history/{event.chat_id}*"
-    response = await bash(event)
     try:
-        await client.send_message(event.chat_id, f"{response}")
-        logging.debug(f"Sent /bash to {event.chat_id}")
+        deleted = await asyncio.to_thread(delete_chat_history, event.chat_id)
+        await client.send_message(
+            event.chat_id, f"**Cleared {deleted} conversations, archives included**"
+        )
+        logging.debug(f"Cleared history of {event.chat_id}")
     except Exception as e:
-        logging.error(f"Error occurred while responding /bash cmd: {e}")
+        logging.error(f"Error occurred while clearing history: {e}")
     raise StopPropagation
 
 
 @register(NewMessage(pattern="/bard"))
 async def bard_chat_handler(event: NewMessage) -> None:
+    await charge_request(event)
     # Get info
     chat_type, client, chat_id, message = await check_chat_type(event)
     if chat_type == "User":
@@ -91,11 +130,8 @@ async def bard_chat_handler(event: NewMessage) -> None:
     logging.debug(f"Check chat type {chat_type} done")
     await client(SetTypingRequest(peer=chat_id, action=SendMessageTypingAction()))
 
-    # Inialize
-    loop = asyncio.get_event_loop()
-
-    # Get response from openAI
-    future = loop.run_in_executor(None, get_bard_response, message)
+    # Get response from bard, shared with identical requests in flight
+    future = coalesce("bard", message, get_bard_response, message)
     while not future.done():  # Loop of random actions indicates running process
         random_choice = random.choice(RANDOM_ACTION)
         await asyncio.sleep(2)
@@ -115,6 +151,7 @@ async def bard_chat_handler(event: NewMessage) -> None:
 
 @register(NewMessage(pattern="/bing"))
 async def bing_chat_handler(event: NewMessage) -> None:
+    await charge_request(event)
     # Get info
     chat_type, client, chat_id, message = await check_chat_type(event)
     if chat_type == "User":
@@ -160,6 +197,7 @@ async def bing_chat_handler(event: NewMessage) -> None:
 
 @register(NewMessage(pattern="/gemini"))
 async def gemini_chat_handler(event: NewMessage) -> None:
+    await charge_request(event)
     # Get info
     chat_type, client, chat_id, message = await check_chat_type(event)
     if chat_type == "User":
@@ -177,9 +215,9 @@ async def gemini_chat_handler(event: NewMessage) -> None:
     # Inialize
     loop = asyncio.get_event_loop()
 
-    # Get response from openAI
+    # Get response from gemini, text-only requests are shared when identical
     if not file_name:
-        future = loop.run_in_executor(None, get_gemini_response, message)
+        future = coalesce("gemini", message, get_gemini_response, message)
     else:
         future = loop.run_in_executor(
             None, get_gemini_vison_response, message, file_name
@@ -206,19 +244,18 @@ async def switch_model_handler(event: NewMessage) -> None:
     model = event.raw_text.split(" ", maxsplit=1)[1]
     client = event.client
     try:
-        if model not in MODEL_DICT:
-            available_models = "**, **".join(MODEL_DICT.keys())
+        if model not in routable_models():
+            available_models = "**, **".join(routable_models())
             await client.send_message(
                 event.chat_id,
                 f"Model not found, available models: **{available_models}**",
             )
-        elif MODEL_DICT[model][0] == src.utils.utils.model:
+        elif model == get_chat_settings(event.chat_id).model_key:
             await client.send_message(
-                event.chat_id, f"**{MODEL_DICT[model][0]}** is being used already"
+                event.chat_id, f"**{model_name(model)}** is being used already"
             )
         else:
-            src.utils.utils.model = MODEL_DICT[model][0]  # Overwrite system MODEL
-            src.utils.utils.max_token = MODEL_DICT[model][1]
+            update_chat_settings(event.chat_id, model_key=model)  # Only this chat
             # TODO: This is wrong but save it for future switchtone
             # if len(glob.glob(f"{LOG_PATH}chats/history/{event.chat_id}*")) > 0:
             #     await client.send_message(
@@ -228,9 +265,9 @@ async def switch_model_handler(event: NewMessage) -> None:
             # else:
             await client.send_message(
                 event.chat_id,
-                f"Successfully set model to **{MODEL_DICT[model][0]}**",
+                f"Successfully set model to **{model_name(model)}**",
             )
-            logging.debug(f"Model switched to {MODEL_DICT[model][0]}")
+            logging.debug(f"Model switched to {model_name(model)} for {event.chat_id}")
     except Exception as e:
         logging.error(f"Error occurred while switching model: {e}")
     raise StopPropagation
@@ -238,20 +275,22 @@ async def switch_model_handler(event: NewMessage) -> None:
 
 @register(NewMessage(pattern="/senpai"))
 async def senpai_chat_handler(event: NewMessage) -> None:
+    await charge_request(event)
     # Get info
     chat_type, client, chat_id, message = await check_chat_type(event)
     if chat_type == "User":
         message = message.split(" ", maxsplit=1)[1]
     logging.debug(f"Check chat type {chat_type} done")
     await client(SetTypingRequest(peer=chat_id, action=SendMessageTypingAction()))
-    src.utils.utils.sys_mess = SYS_MESS_SENPAI  # Overwrite system mess
+    settings = update_chat_settings(chat_id, persona=default_persona("senpai"))
 
     # Inialize
-    filename, prompt = await start_and_check(event, message, chat_id)
-    loop = asyncio.get_event_loop()
+    filename, prompt = await start_and_check(event, message, chat_id, settings)
 
-    # Get response from openAI
-    future = loop.run_in_executor(None, get_openai_response, prompt, filename)
+    # Get response from openAI, to_thread keeps the bot of this update
+    future = asyncio.ensure_future(
+        asyncio.to_thread(get_openai_response, prompt, filename, settings)
+    )
     while not future.done():  # Loop of random actions indicates running process
         random_choice = random.choice(RANDOM_ACTION)
         await asyncio.sleep(2)
@@ -277,15 +316,17 @@ async def user_chat_handler(event: NewMessage) -> None:
         return
     else:
         logging.debug(f"Check chat type {chat_type} done")
+    await charge_request(event)
     await client(SetTypingRequest(peer=chat_id, action=SendMessageTypingAction()))
-    src.utils.utils.sys_mess = SYS_MESS_SENPAI  # Overwrite system mess
+    settings = update_chat_settings(chat_id, persona=default_persona("senpai"))
 
     # Inialize
-    filename, prompt = await start_and_check(event, message, chat_id)
-    loop = asyncio.get_event_loop()
+    filename, prompt = await start_and_check(event, message, chat_id, settings)
 
-    # Get response from openAI
-    future = loop.run_in_executor(None, get_openai_response, prompt, filename)
+    # Get response from openAI, to_thread keeps the bot of this update
+    future = asyncio.ensure_future(
+        asyncio.to_thread(get_openai_response, prompt, filename, settings)
+    )
     while not future.done():  # Loop of random actions indicates running process
         random_choice = random.choice(RANDOM_ACTION)
         await asyncio.sleep(2)
@@ -311,15 +352,17 @@ async def group_chat_handler(event: NewMessage) -> None:
         return
     else:
         logging.debug(f"Check chat type {chat_type} done")
+    await charge_request(event)
     await client(SetTypingRequest(peer=chat_id, action=SendMessageTypingAction()))
-    src.utils.utils.sys_mess = SYS_MESS_FRIENDLY  # Overwrite system mess
+    settings = update_chat_settings(chat_id, persona=default_persona("friendly"))
 
     # Inialize
-    filename, prompt = await start_and_check(event, message, chat_id)
-    loop = asyncio.get_event_loop()
+    filename, prompt = await start_and_check(event, message, chat_id, settings)
 
-    # Get response from openAI
-    future = loop.run_in_executor(None, get_openai_response, prompt, filename)
+    # Get response from openAI, to_thread keeps the bot of this update
+    future = asyncio.ensure_future(
+        asyncio.to_thread(get_openai_response, prompt, filename, settings)
+    )
     while not future.done():  # Loop of random actions indicates running process
         random_choice = random.choice(RANDOM_ACTION)
         await asyncio.sleep(2)
@@ -1,28 +1,60 @@
 import asyncio
 import logging
+import os
 import subprocess
 from contextlib import asynccontextmanager
-from typing import Generator
+from typing import Generator, Optional
 
 import uvicorn
-from fastapi import FastAPI, Request, Response, status
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 
 from __version__ import __version__
 from src.bot import bot
 from src.utils import (
     BOT_NAME,
+    DEFAULT_BOT,
     LOG_PATH,
+    ProfilerBusy,
+    bots_report,
+    bound_to_bot,
+    breaker_report,
+    compactor,
+    connection_report,
     create_initial_folders,
+    current_bot,
+    dump_tasks,
+    export_history,
     get_date_time,
+    import_history_record,
     initialize_logging,
+    lifecycle,
+    preload_providers,
+    profile,
+    record_startup_stage,
+    routing_report,
+    startup_report,
+    stored_bots,
     terminal_html,
+    warm_up_tokenizer,
+    watchdog,
 )
 
 # Initialize
 create_initial_folders()
 console_out = initialize_logging()
 time_str = get_date_time("Asia/Ho_Chi_Minh")
+record_startup_stage("app imported")
+
+# Debug endpoints are disabled unless a token is configured
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+
+IMPORT_MAX_LINE = 64 * 1024 * 1024
 
 # Bot version
 try:
@@ -39,12 +71,35 @@ async def lifespan(app: FastAPI):
         task = loop.create_task(bot())
         background_tasks.add(task)
         task.add_done_callback(background_tasks.discard)
+        compactor_task = loop.create_task(compactor())
+        background_tasks.add(compactor_task)
+        compactor_task.add_done_callback(background_tasks.discard)
+        watchdog_task = loop.create_task(watchdog.heartbeat())
+        background_tasks.add(watchdog_task)
+        watchdog_task.add_done_callback(background_tasks.discard)
+        session_task = loop.create_task(lifecycle.save_sessions())
+        background_tasks.add(session_task)
+        session_task.add_done_callback(background_tasks.discard)
+        # Import enabled providers off the event loop so health checks pass early
+        preload_task = loop.run_in_executor(None, preload_providers)
+        preload_task.add_done_callback(
+            lambda _: record_startup_stage("providers preloaded")
+        )
+        tokenizer_task = loop.run_in_executor(None, warm_up_tokenizer)
+        tokenizer_task.add_done_callback(
+            lambda _: record_startup_stage("tokenizer warmed up")
+        )
+        record_startup_stage("app initiated")
         logging.info("App initiated")
     except Exception as e:
         logging.critical(f"Error occurred while starting up app: {e}")
         raise e
     yield
     logging.info("Application close...")
+    # Stop taking updates, let handlers in flight finish, hand the rest over
+    await lifecycle.shutdown()
+    for task in background_tasks:
+        task.cancel()
 
 
 # API and app handling
@@ -57,8 +112,20 @@ async def root() -> str:
 
 
 @app.get("/health", status_code=status.HTTP_200_OK)
-async def health_check() -> str:
-    return f"{BOT_NAME} {BOT_VERSION} health check"
+async def health_check() -> JSONResponse:
+    # Fails for a while after the event loop was blocked for too long
+    healthy = watchdog.healthy()
+    return JSONResponse(
+        {
+            "status": f"{BOT_NAME} {BOT_VERSION} health check",
+            "healthy": healthy,
+            **watchdog.report(),
+            "connections": connection_report(),
+        },
+        status_code=status.HTTP_200_OK
+        if healthy
+        else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
 
 
 @app.get("/log")
@@ -70,6 +137,107 @@ async def log_check() -> StreamingResponse:
     return StreamingResponse(generate_log())
 
 
+def verify_debug_token(token: Optional[str] = None) -> None:
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if token != DEBUG_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+
+
+@app.get("/debug/startup", dependencies=[Depends(verify_debug_token)])
+async def startup_check() -> PlainTextResponse:
+    return PlainTextResponse(startup_report())
+
+
+@app.get("/debug/routing", dependencies=[Depends(verify_debug_token)])
+async def routing_check() -> dict:
+    return routing_report()
+
+
+@app.get("/debug/providers", dependencies=[Depends(verify_debug_token)])
+async def providers_check() -> dict:
+    return breaker_report()
+
+
+@app.get("/debug/bots", dependencies=[Depends(verify_debug_token)])
+async def bots_check() -> dict:
+    return bots_report()
+
+
+@app.get("/debug/stalls", dependencies=[Depends(verify_debug_token)])
+async def stalls_check() -> list:
+    return watchdog.stall_report()
+
+
+@app.get("/debug/profile", dependencies=[Depends(verify_debug_token)])
+async def profile_check(
+    seconds: float = 10, interval: float = 0.01, tasks: bool = False
+) -> Response:
+    # Collapsed stacks of all threads, ready for flamegraph.pl or speedscope
+    try:
+        collapsed = await profile(seconds, interval)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if not tasks:
+        return PlainTextResponse(collapsed)
+    return JSONResponse({"collapsed": collapsed, "tasks": dump_tasks()})
+
+
+def verify_bot(bot: str) -> None:
+    if bot not in stored_bots():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+
+@app.get("/history/export", dependencies=[Depends(verify_debug_token)])
+async def history_export(
+    chat_id: Optional[int] = None,
+    session_from: Optional[int] = None,
+    session_to: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    bot: str = DEFAULT_BOT,
+) -> StreamingResponse:
+    verify_bot(bot)
+    # A sync generator, Starlette pulls it from a worker thread one session at a time
+    records = bound_to_bot(
+        bot, export_history(chat_id, session_from, session_to, since, until)
+    )
+    return StreamingResponse(records, media_type="application/x-ndjson")
+
+
+@app.post("/history/import", dependencies=[Depends(verify_debug_token)])
+async def history_import(
+    request: Request, overwrite: bool = False, bot: str = DEFAULT_BOT
+) -> dict:
+    verify_bot(bot)
+    current_bot.set(bot)
+    counts = {"imported": 0, "skipped": 0, "failed": 0}
+
+    async def import_line(line: bytes) -> None:
+        if not line.strip():
+            return
+        try:
+            result = await asyncio.to_thread(import_history_record, line, overwrite)
+            counts[result] += 1
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Error occurred while importing a history record: {e}")
+            counts["failed"] += 1
+
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer += chunk
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                break
+            await import_line(bytes(buffer[:end]))
+            del buffer[: end + 1]
+        if len(buffer) > IMPORT_MAX_LINE:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    await import_line(bytes(buffer))
+    return counts
+
+
 # @app.get("/terminal", response_class=HTMLResponse)
 # async def terminal(request: Request) -> Response:
 #     return Response(content=terminal_html(), media_type="text/html")
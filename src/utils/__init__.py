@@ -1 +1,17 @@
 from .utils import *
+from .message import *
+from .archive import *
+from .providers import *
+from .tokenizer import *
+from .retrieval import *
+from .router import *
+from .settings import *
+from .admission import *
+from .singleflight import *
+from .provider_client import *
+from .lifecycle import *
+from .transfer import *
+from .watchdog import *
+from .profiler import *
+from .bots import *
+from .connection import *
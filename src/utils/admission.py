@@ -0,0 +1,167 @@
+import ast
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, FrozenSet, Optional
+
+from .tokenizer import estimate_tokens
+from .utils import LOG_PATH
+
+# Optional JSON file overriding the env settings below, re-read when it changes:
+# {"allow_users": [...], "user_messages_per_minute": 20, ...}
+ADMISSION_CONFIG = os.getenv("ADMISSION_CONFIG", f"{LOG_PATH}admission.json")
+CONFIG_CHECK_INTERVAL = 5
+REPLY_COOLDOWN = 60
+MAX_BUCKETS = 10000
+
+NOT_ALLOWED_REPLY = "This is personal property, you are not allowed to proceed!"
+OVER_LIMIT_REPLY = "🐢 Slow down, you are sending too much, try again in a minute"
+
+
+def parse_allow_users(value: Optional[str]) -> FrozenSet[int]:
+    if not value:
+        return frozenset()
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        parsed = [item for item in value.replace(";", ",").split(",") if item.strip()]
+    if isinstance(parsed, (int, str)):
+        parsed = [parsed]
+    return frozenset(int(item) for item in parsed)
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Admission:
+    """Allow-list checked on every message, rate limits on the requests answered."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.config_mtime: Optional[float] = None
+        self.config_checked = 0.0
+        self.buckets: Dict[tuple, TokenBucket] = {}
+        self.last_reply: Dict[int, float] = {}
+        self.load_config({})
+
+    def load_config(self, config: dict) -> None:
+        if "allow_users" in config:
+            self.allow_users = frozenset(int(user) for user in config["allow_users"])
+        else:
+            self.allow_users = parse_allow_users(os.getenv("ALLOW_USERS"))
+        self.limits = {
+            name: float(config.get(name, os.getenv(name.upper(), default)))
+            for name, default in (
+                ("user_messages_per_minute", 20),
+                ("chat_messages_per_minute", 60),
+                ("user_tokens_per_minute", 8000),
+                ("chat_tokens_per_minute", 20000),
+            )
+        }
+        # Buckets are rebuilt lazily with the new limits
+        self.buckets.clear()
+
+    def maybe_reload(self, now: float) -> None:
+        if now - self.config_checked < CONFIG_CHECK_INTERVAL:
+            return
+        self.config_checked = now
+        try:
+            mtime = os.stat(ADMISSION_CONFIG).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.config_mtime:
+            return
+        config = {}
+        if mtime is not None:
+            try:
+                with open(ADMISSION_CONFIG, "r") as f:
+                    config = json.load(f)
+            except Exception as e:
+                logging.error(f"Error occurred while reading admission config: {e}")
+                return
+        self.config_mtime = mtime
+        self.load_config(config)
+        logging.info(f"Admission config reloaded: {self.limits}")
+
+    def bucket(self, key: tuple, per_minute: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.prune()
+            bucket = self.buckets[key] = TokenBucket(per_minute)
+        return bucket
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    def check(
+        self, chat_id: int, allow_users: Optional[FrozenSet[int]] = None
+    ) -> Optional[str]:
+        """None if the chat is allowed, else the reply to send.
+
+        allow_users replaces the configured allow-list, rate limits stay shared.
+        """
+        with self.lock:
+            self.maybe_reload(time.monotonic())
+            if allow_users is None:
+                allow_users = self.allow_users
+            if chat_id not in allow_users:
+                return NOT_ALLOWED_REPLY
+        return None
+
+    def charge(self, chat_id: int, user_id: Optional[int], text: str) -> Optional[str]:
+        """Take a message from the rate limits, only for updates the bot answers."""
+        now = time.monotonic()
+        with self.lock:
+            self.maybe_reload(now)
+            tokens = estimate_tokens(text or "")
+            user_id = user_id or chat_id
+            limits = self.limits
+            checks = (
+                (("um", user_id), limits["user_messages_per_minute"], 1),
+                (("cm", chat_id), limits["chat_messages_per_minute"], 1),
+                (("ut", user_id), limits["user_tokens_per_minute"], tokens),
+                (("ct", chat_id), limits["chat_tokens_per_minute"], tokens),
+            )
+            buckets = []
+            for key, per_minute, amount in checks:
+                bucket = self.bucket(key, per_minute)
+                bucket.refill(now)
+                # A single message bigger than the bucket is capped, not refused
+                amount = min(amount, per_minute)
+                if bucket.tokens < amount:
+                    return OVER_LIMIT_REPLY
+                buckets.append((bucket, amount))
+            for bucket, amount in buckets:
+                bucket.tokens -= amount
+        return None
+
+    def should_reply(self, chat_id: int) -> bool:
+        # Refusals are sent at most once per cooldown so floods stay cheap
+        now = time.monotonic()
+        if now - self.last_reply.get(chat_id, 0.0) < REPLY_COOLDOWN:
+            return False
+        if len(self.last_reply) >= MAX_BUCKETS:
+            self.last_reply.clear()
+        self.last_reply[chat_id] = now
+        return True
+
+
+admission = Admission()
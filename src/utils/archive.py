@@ -0,0 +1,218 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from .utils import Prompt, chats_path, current_bot, stored_bots
+
+# Retired sessions are appended as independent zlib blobs to one archive per chat,
+# the index maps each session number to its (offset, length) inside the archive
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 600))
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", 50 * 1024 * 1024))
+ARCHIVE_MAX_SESSIONS = int(os.getenv("ARCHIVE_MAX_SESSIONS", 0))  # 0 means no limit
+
+HISTORY_FILE_PATTERN = re.compile(r"^(-?\d+)_(\d+)\.json$")
+
+
+def archive_path() -> str:
+    return f"{chats_path()}archive/"
+
+
+def archive_filenames(chat_id: int) -> tuple:
+    return f"{archive_path()}{chat_id}.arc", f"{archive_path()}{chat_id}.idx"
+
+
+def load_archive_index(chat_id: int) -> Dict[str, list]:
+    _, index_file = archive_filenames(chat_id)
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def save_archive_index(chat_id: int, index: Dict[str, list]) -> None:
+    _, index_file = archive_filenames(chat_id)
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, index_file)
+
+
+def current_session(chat_id: int) -> Optional[int]:
+    try:
+        with open(f"{chats_path()}session/{chat_id}.json", "r") as f:
+            return json.load(f)["session"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def retired_sessions() -> Dict[int, List[int]]:
+    """Map chat_id to its history session numbers older than the active one."""
+    retired = {}
+    for entry in os.scandir(f"{chats_path()}history"):
+        match = HISTORY_FILE_PATTERN.match(entry.name)
+        if not match:
+            continue
+        chat_id, file_num = int(match.group(1)), int(match.group(2))
+        retired.setdefault(chat_id, []).append(file_num)
+    for chat_id in list(retired):
+        active = current_session(chat_id)
+        if active is None:
+            # Without a readable pointer the live session is unknown, leave the chat
+            del retired[chat_id]
+            continue
+        sessions = sorted(n for n in retired[chat_id] if n < active)
+        if sessions:
+            retired[chat_id] = sessions
+        else:
+            del retired[chat_id]
+    return retired
+
+
+def compact_chat(chat_id: int, sessions: List[int]) -> int:
+    archive_file, _ = archive_filenames(chat_id)
+    index = load_archive_index(chat_id)
+    saved = 0
+    archived = {}
+    with open(archive_file, "ab") as arc:
+        for file_num in sessions:
+            filename = f"{chats_path()}history/{chat_id}_{file_num}.json"
+            stat = os.stat(filename)
+            archived[filename] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            entry = index.get(str(file_num))
+            # A session saved again after it was archived is archived again
+            if entry is None or stat.st_mtime >= entry[3]:
+                with open(filename, "r") as f:
+                    data = json.load(f)
+                raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+                blob = zlib.compress(raw, 9)
+                offset = arc.seek(0, os.SEEK_END)
+                arc.write(blob)
+                index[str(file_num)] = [offset, len(blob), len(raw), int(time.time())]
+                saved += stat.st_size - len(blob)
+        arc.flush()
+        os.fsync(arc.fileno())
+    # Only drop the json files once the index pointing at their blobs is durable
+    save_archive_index(chat_id, index)
+    for filename, key in archived.items():
+        stat = os.stat(filename)
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != key:
+            # A late save landed after the read, keep it for the next run
+            continue
+        os.remove(filename)
+    return saved
+
+
+def read_archived_session(chat_id: int, file_num: int) -> Optional[Prompt]:
+    archive_file, _ = archive_filenames(chat_id)
+    entry = load_archive_index(chat_id).get(str(file_num))
+    if entry is None:
+        return None
+    offset, length = entry[0], entry[1]
+    with open(archive_file, "rb") as arc:
+        arc.seek(offset)
+        blob = arc.read(length)
+    return json.loads(zlib.decompress(blob))["messages"]
+
+
+def drop_archived_sessions(chat_id: int, file_nums: List[int]) -> None:
+    # Imported here, retrieval reads archives through this module
+    from .retrieval import invalidate_chat_index
+
+    archive_file, _ = archive_filenames(chat_id)
+    index = load_archive_index(chat_id)
+    keep = {k: v for k, v in index.items() if int(k) not in file_nums}
+    if not keep:
+        os.remove(archive_file)
+        os.remove(archive_filenames(chat_id)[1])
+        invalidate_chat_index(chat_id)
+        return
+    # Rewrite the archive with the surviving blobs only
+    tmp_file = f"{archive_file}.tmp"
+    new_index = {}
+    with open(archive_file, "rb") as src, open(tmp_file, "wb") as dst:
+        for key, (offset, length, raw_size, retired_at) in sorted(
+            keep.items(), key=lambda item: item[1][0]
+        ):
+            src.seek(offset)
+            new_index[key] = [dst.tell(), length, raw_size, retired_at]
+            dst.write(src.read(length))
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_file, archive_file)
+    save_archive_index(chat_id, new_index)
+    # Retrieval must not return turns dropped by retention
+    invalidate_chat_index(chat_id)
+
+
+def enforce_retention() -> int:
+    """ARCHIVE_MAX_SESSIONS applies per chat, ARCHIVE_MAX_BYTES to all bots together."""
+    entries = []
+    total_size = 0
+    for bot in stored_bots():
+        token = current_bot.set(bot)
+        try:
+            for index_file in glob.glob(f"{archive_path()}*.idx"):
+                chat_id = int(os.path.basename(index_file)[: -len(".idx")])
+                index = load_archive_index(chat_id)
+                sessions = sorted(index.items(), key=lambda item: int(item[0]))
+                if ARCHIVE_MAX_SESSIONS and len(sessions) > ARCHIVE_MAX_SESSIONS:
+                    overflow = sessions[: len(sessions) - ARCHIVE_MAX_SESSIONS]
+                    drop_archived_sessions(chat_id, [int(k) for k, _ in overflow])
+                    sessions = sessions[len(overflow) :]
+                for key, (_, length, _, retired_at) in sessions:
+                    entries.append((retired_at, bot, chat_id, int(key), length))
+                    total_size += length
+        finally:
+            current_bot.reset(token)
+
+    # Drop the oldest sessions across all bots and chats until we are within budget
+    to_drop = {}
+    for retired_at, bot, chat_id, file_num, length in sorted(entries):
+        if total_size <= ARCHIVE_MAX_BYTES:
+            break
+        to_drop.setdefault((bot, chat_id), []).append(file_num)
+        total_size -= length
+    for (bot, chat_id), file_nums in to_drop.items():
+        token = current_bot.set(bot)
+        try:
+            drop_archived_sessions(chat_id, file_nums)
+        finally:
+            current_bot.reset(token)
+    return sum(len(file_nums) for file_nums in to_drop.values())
+
+
+def run_compaction() -> None:
+    # Each bot has its own store, the size budget is shared by all of them
+    saved = 0
+    for bot in stored_bots():
+        token = current_bot.set(bot)
+        try:
+            for chat_id, sessions in retired_sessions().items():
+                try:
+                    saved += compact_chat(chat_id, sessions)
+                except Exception as e:
+                    logging.error(
+                        f"Error occurred while compacting chat {chat_id}: {e}"
+                    )
+        finally:
+            current_bot.reset(token)
+    dropped = enforce_retention()
+    logging.debug(f"Compaction done, saved {saved} bytes, dropped {dropped} sessions")
+
+
+async def compactor() -> None:
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, run_compaction)
+        except Exception as e:
+            logging.error(f"Error occurred while running compactor: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
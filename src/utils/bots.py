@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict, FrozenSet, List, Optional
+
+from .admission import parse_allow_users
+from .utils import DEFAULT_BOT, current_bot
+
+# Extra bots served by the same process, as a JSON list in the environment:
+# [{"name": "brand", "token": "...", "allow_users": [...], "persona": "friendly"}]
+BOT_NAME_PATTERN = re.compile(r"^\w+$")
+
+
+class BotIdentity:
+    """One bot token, with its own allow-list, default persona and counters."""
+
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        allow_users: Optional[FrozenSet[int]] = None,
+        persona: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.token = token
+        self.allow_users = allow_users  # None falls back to the admission config
+        self.persona = persona  # None keeps senpai for users, friendly for groups
+        self.client = None
+        self.started_at = time.time()
+        self.metrics = {"received": 0, "refused": 0, "replies": 0}
+
+    def report(self) -> dict:
+        return {
+            **self.metrics,
+            "connected": bool(self.client and self.client.is_connected()),
+            "uptime": round(time.time() - self.started_at),
+            "persona": self.persona,
+        }
+
+
+identities: Dict[str, BotIdentity] = {}
+
+
+def load_bots(default_token: str) -> List[BotIdentity]:
+    identities.clear()
+    identities[DEFAULT_BOT] = BotIdentity(DEFAULT_BOT, default_token)
+    try:
+        configs = json.loads(os.getenv("BOTS") or "[]")
+    except ValueError as e:
+        logging.error(f"Error occurred while reading BOTS: {e}")
+        configs = []
+    for config in configs:
+        name = str(config.get("name", ""))
+        if not BOT_NAME_PATTERN.match(name) or name in identities:
+            logging.error(f"Skipped bot with a missing or duplicate name: {name!r}")
+            continue
+        allow_users = config.get("allow_users")
+        identities[name] = BotIdentity(
+            name,
+            config["token"],
+            None if allow_users is None else parse_allow_users(str(allow_users)),
+            config.get("persona"),
+        )
+    return list(identities.values())
+
+
+def identity_of(client) -> Optional[BotIdentity]:
+    for identity in identities.values():
+        if identity.client is client:
+            return identity
+    return None
+
+
+def current_identity() -> Optional[BotIdentity]:
+    return identities.get(current_bot.get())
+
+
+def default_persona(fallback: str) -> str:
+    identity = current_identity()
+    return identity.persona if identity and identity.persona else fallback
+
+
+def record_bot_metric(name: str) -> None:
+    identity = current_identity()
+    if identity is not None:
+        identity.metrics[name] += 1
+
+
+def bots_report() -> Dict[str, dict]:
+    return {
+        identity.name or "default": identity.report()
+        for identity in identities.values()
+    }
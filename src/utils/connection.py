@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, Optional
+
+from telethon import TelegramClient
+
+from .lifecycle import lifecycle
+from .utils import current_bot
+
+RECONNECT_BASE = float(os.getenv("RECONNECT_BASE", 1))
+RECONNECT_MAX = float(os.getenv("RECONNECT_MAX", 60))
+SEND_RESUME_TIMEOUT = float(os.getenv("SEND_RESUME_TIMEOUT", 120))
+STABLE_AFTER = 60  # A connection that lasted this long resets the backoff
+SEND_ATTEMPTS = 3
+
+
+class Supervisor:
+    """Keeps one client and its handlers alive, reconnecting it with backoff.
+
+    Telethon retries a dropped connection a few times on its own, once it
+    gives up the supervisor reconnects the same client with the saved auth
+    key, so handlers stay registered and nothing in flight loses its client.
+    """
+
+    def __init__(self, name: str, client: TelegramClient, bot_token: str) -> None:
+        self.name = name
+        self.client = client
+        self.bot_token = bot_token
+        self.state = "connecting"
+        self.reconnects = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.connected_at: Optional[float] = None
+        self.disconnected_at: Optional[float] = None
+        self.connected = asyncio.Event()
+
+    async def run(self) -> None:
+        while True:
+            self.state = "connected"
+            self.connected_at = time.monotonic()
+            self.connected.set()
+            try:
+                await self.client.run_until_disconnected()
+            except Exception as e:
+                self.last_error = str(e)
+                logging.error(f"Error occurred in bot {self.name or 'default'}: {e}")
+            self.connected.clear()
+            self.disconnected_at = time.monotonic()
+            if not lifecycle.accepting:
+                self.state = "stopped"
+                return
+            if self.disconnected_at - self.connected_at > STABLE_AFTER:
+                self.failures = 0
+            await self.reconnect()
+
+    async def reconnect(self) -> None:
+        self.state = "reconnecting"
+        while lifecycle.accepting:
+            self.failures += 1
+            # Jittered, so bots and replicas do not retry in lockstep
+            delay = min(RECONNECT_MAX, RECONNECT_BASE * 2 ** (self.failures - 1))
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            try:
+                await self.client.connect()
+                if not await self.client.is_user_authorized():
+                    await self.client.sign_in(bot_token=self.bot_token)
+            except Exception as e:
+                self.last_error = str(e)
+                logging.error(
+                    f"Error occurred while reconnecting bot {self.name or 'default'}"
+                    f" (attempt {self.failures}): {e}"
+                )
+                continue
+            self.reconnects += 1
+            logging.info(f"Reconnected bot {self.name or 'default'}")
+            try:
+                await self.client.catch_up()
+            except Exception as e:
+                logging.error(f"Error occurred while catching up: {e}")
+            return
+
+    async def wait_connected(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while not self.client.is_connected() and time.monotonic() < deadline:
+            if self.connected.is_set():
+                # Dropped, run_until_disconnected has not returned yet
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                await asyncio.wait_for(
+                    self.connected.wait(), deadline - time.monotonic()
+                )
+            except asyncio.TimeoutError:
+                return
+
+    def report(self) -> dict:
+        down_since = self.disconnected_at if not self.connected.is_set() else None
+        return {
+            "state": self.state,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "down_for": round(time.monotonic() - down_since) if down_since else 0,
+            "last_error": self.last_error,
+        }
+
+
+supervisors: Dict[str, Supervisor] = {}
+
+
+async def send_when_connected(client: TelegramClient, *args, **kwargs):
+    """client.send_message that waits out a reconnect instead of dropping the reply."""
+    supervisor = supervisors.get(current_bot.get())
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        if supervisor is not None:
+            await supervisor.wait_connected(SEND_RESUME_TIMEOUT)
+        try:
+            return await client.send_message(*args, **kwargs)
+        except ConnectionError as e:
+            if supervisor is None or attempt == SEND_ATTEMPTS:
+                raise
+            logging.warning(f"Send interrupted by a disconnect, retrying: {e}")
+
+
+def connection_report() -> Dict[str, dict]:
+    return {
+        name or "default": supervisor.report()
+        for name, supervisor in supervisors.items()
+    }
@@ -0,0 +1,149 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.events import NewMessage, StopPropagation
+from telethon.sessions import SQLiteSession
+
+from .utils import DEFAULT_BOT, LOG_PATH, atomic_write_json, current_bot
+
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 20))
+SESSION_SAVE_INTERVAL = float(os.getenv("SESSION_SAVE_INTERVAL", 30))
+PENDING_FILE = f"{LOG_PATH}pending.json"
+SEEN_UPDATES = 4096
+
+
+def session_file(bot: str = DEFAULT_BOT) -> str:
+    # Telethon adds the .session extension
+    return f"{LOG_PATH}telethon{'.' + bot if bot else ''}"
+
+
+def open_session(bot: str = DEFAULT_BOT) -> SQLiteSession:
+    """Keeps the auth key, the entity cache and the update state across restarts."""
+    return SQLiteSession(session_file(bot))
+
+
+class Lifecycle:
+    """Tracks updates in flight so a shutdown can drain them or hand them over."""
+
+    def __init__(self) -> None:
+        self.accepting = True
+        self.clients: Dict[str, TelegramClient] = {}
+        self.inflight: Dict[Tuple[str, int, int], asyncio.Task] = {}
+        self.pending: List[Tuple[str, int, int]] = []
+        self.to_replay: Optional[Dict[str, List[Tuple[int, int]]]] = None
+        self.seen: "OrderedDict[Tuple[str, int, int], None]" = OrderedDict()
+
+    def track(self, event: NewMessage) -> None:
+        """Called first for every message, raises StopPropagation while draining."""
+        key = (current_bot.get(), event.chat_id, event.id)
+        # Caught up updates may also be in the pending replay, handle them once
+        if key in self.seen:
+            raise StopPropagation
+        self.seen[key] = None
+        if len(self.seen) > SEEN_UPDATES:
+            self.seen.popitem(last=False)
+        if not self.accepting:
+            self.pending.append(key)
+            raise StopPropagation
+        task = asyncio.current_task()
+        # A task handling a new update is done with the previous one
+        for other, other_task in list(self.inflight.items()):
+            if other_task is task:
+                del self.inflight[other]
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+    async def shutdown(self) -> None:
+        self.accepting = False
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        logging.info(f"Draining {len(self.inflight)} updates in flight")
+        while self.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        # Whatever did not finish is handed over to the next instance
+        for key, task in list(self.inflight.items()):
+            self.pending.append(key)
+            task.cancel()
+        self.inflight.clear()
+        if self.pending:
+            atomic_write_json(PENDING_FILE, sorted(set(self.pending)))
+            logging.info(f"Saved {len(self.pending)} pending updates")
+        for client in self.clients.values():
+            # Also saves the session, the next start catches up from here
+            await client.disconnect()
+        logging.info("Shutdown complete")
+
+    async def save_sessions(self) -> None:
+        """Commit entities and update state now and then, not only on shutdown."""
+        while True:
+            await asyncio.sleep(SESSION_SAVE_INTERVAL)
+            for client in self.clients.values():
+                try:
+                    client.session.save()
+                except Exception as e:
+                    logging.error(f"Error occurred while saving the session: {e}")
+
+    def load_pending(self) -> Dict[str, List[Tuple[int, int]]]:
+        # Read once, each bot then takes its own entries
+        if self.to_replay is None:
+            self.to_replay = {}
+            try:
+                with open(PENDING_FILE, "r") as f:
+                    pending = json.load(f)
+                os.remove(PENDING_FILE)
+            except (OSError, ValueError):
+                pending = []
+            for bot, chat_id, message_id in pending:
+                self.to_replay.setdefault(bot, []).append((chat_id, message_id))
+        return self.to_replay
+
+    async def replay_pending(self, client: TelegramClient) -> None:
+        """Run the messages left over by the previous instance through the handlers."""
+        pending = self.load_pending().pop(current_bot.get(), [])
+        if not pending:
+            return
+        by_chat: Dict[int, List[int]] = {}
+        for chat_id, message_id in pending:
+            by_chat.setdefault(chat_id, []).append(message_id)
+        handlers = [
+            (callback, builder)
+            for callback, builder in client.list_event_handlers()
+            if isinstance(builder, NewMessage)
+        ]
+        for chat_id, message_ids in by_chat.items():
+            try:
+                messages = await client.get_messages(chat_id, ids=message_ids)
+            except Exception as e:
+                logging.error(f"Error occurred while fetching pending messages: {e}")
+                continue
+            for message in messages:
+                if message is not None:
+                    asyncio.create_task(self.dispatch(client, handlers, message))
+        logging.info(f"Replaying {len(pending)} pending updates")
+
+    async def dispatch(self, client: TelegramClient, handlers: list, message) -> None:
+        event = NewMessage.Event(message)
+        event._set_client(client)
+        for callback, builder in handlers:
+            if not builder.resolved:
+                await builder.resolve(client)
+            matched = builder.filter(event)
+            if inspect.isawaitable(matched):
+                matched = await matched
+            if not matched:
+                continue
+            try:
+                await callback(event)
+            except StopPropagation:
+                break
+            except Exception as e:
+                logging.error(f"Error occurred while replaying {message.id}: {e}")
+
+
+lifecycle = Lifecycle()
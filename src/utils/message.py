@@ -0,0 +1,81 @@
+import json
+import sys
+from typing import Iterable, List, Optional, Tuple, Union
+
+ROLES = {
+    role: sys.intern(role) for role in ("system", "user", "assistant", "function")
+}
+
+
+def intern_role(role: str) -> str:
+    return ROLES.get(role) or sys.intern(role)
+
+
+class Message:
+    """One chat turn, read like the {"role": ..., "content": ...} dict it replaces.
+
+    Roles are interned and nothing but role and content is kept, the JSON form
+    is built when saving. Treat it as immutable.
+    """
+
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: Optional[str]) -> None:
+        self.role = intern_role(role)
+        self.content = content or ""
+
+    @classmethod
+    def from_dict(cls, data: Union[dict, "Message"]) -> "Message":
+        # Also takes an OpenAIObject, only role and content are kept
+        if isinstance(data, Message):
+            return data
+        return cls(data["role"], data.get("content"))
+
+    def to_api(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def to_disk(self) -> str:
+        return json.dumps(self.to_api(), ensure_ascii=False, separators=(",", ":"))
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> Tuple[str, str]:
+        return ("role", "content")
+
+    def items(self) -> List[Tuple[str, str]]:
+        return [("role", self.role), ("content", self.content)]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Message, dict)):
+            return self.role == other.get("role") and self.content == other.get(
+                "content"
+            )
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content[:40]!r})"
+
+
+def to_messages(items: Iterable[Union[dict, Message]]) -> List[Message]:
+    return [Message.from_dict(item) for item in items]
+
+
+def to_api(messages: Iterable[Union[dict, Message]]) -> List[dict]:
+    """The request payload, built only when calling the API."""
+    return [Message.from_dict(message).to_api() for message in messages]
+
+
+def dumps_conversation(messages: Iterable[Union[dict, Message]]) -> str:
+    encoded = ",".join(Message.from_dict(message).to_disk() for message in messages)
+    return f'{{"messages":[{encoded}]}}'
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+PROFILE_MAX_SECONDS = 60
+PROFILE_MIN_INTERVAL = 0.001
+
+profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def collapse_stacks(seconds: float, interval: float) -> str:
+    """Sample every thread's stack, one "thread;outer;...;inner count" line each."""
+    own_ident = threading.get_ident()
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+
+
+async def profile(seconds: float, interval: float = 0.01) -> str:
+    """Run the sampler on its own thread, the executor may be the thing that is busy."""
+    if not profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    seconds = min(max(seconds, 0.0), PROFILE_MAX_SECONDS)
+    interval = max(interval, PROFILE_MIN_INTERVAL)
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def run() -> None:
+        try:
+            result = collapse_stacks(seconds, interval)
+            loop.call_soon_threadsafe(future.set_result, result)
+        except Exception as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        finally:
+            profile_lock.release()
+
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+    return await future
+
+
+def awaiting(coro) -> List[str]:
+    # Follow the await chain down to the innermost coroutine
+    chain = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is not None:
+            chain.append(f"{frame_label(frame)} line {frame.f_lineno}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return chain
+
+
+def dump_tasks(loop: Optional[asyncio.AbstractEventLoop] = None) -> List[dict]:
+    """What each pending task is waiting on, must be called from the loop thread."""
+    tasks = []
+    for task in asyncio.all_tasks(loop):
+        tasks.append(
+            {
+                "name": task.get_name(),
+                "coro": getattr(task.get_coro(), "__qualname__", "?"),
+                "awaiting": awaiting(task.get_coro()),
+            }
+        )
+    return sorted(tasks, key=lambda task: task["coro"])
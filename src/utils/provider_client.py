@@ -0,0 +1,160 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+MAX_ATTEMPTS = int(os.getenv("PROVIDER_MAX_ATTEMPTS", 4))
+BACKOFF_BASE = float(os.getenv("PROVIDER_BACKOFF_BASE", 0.5))
+BACKOFF_CAP = float(os.getenv("PROVIDER_BACKOFF_CAP", 8))
+REQUEST_DEADLINE = float(os.getenv("PROVIDER_DEADLINE", 90))
+ATTEMPT_TIMEOUT = float(os.getenv("PROVIDER_ATTEMPT_TIMEOUT", 60))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+
+
+class ProviderUnavailable(Exception):
+    """Raised without calling the backend while its circuit is open."""
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half open after a cooldown."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_busy = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            return "half-open"
+        return "open"
+
+    def before_call(self) -> None:
+        with self.lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.half_open_busy):
+                raise ProviderUnavailable(f"{self.name} is unavailable, try later")
+            if state == "half-open":
+                # Let a single probe through to test the backend
+                self.half_open_busy = True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open_busy = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.half_open_busy = False
+            if self.opened_at is not None or self.failures >= BREAKER_THRESHOLD:
+                self.opened_at = time.monotonic()
+                logging.warning(f"Circuit of {self.name} opened")
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    breaker = breakers.get(provider)
+    if breaker is None:
+        breaker = breakers.setdefault(provider, CircuitBreaker(provider))
+    return breaker
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or getattr(
+        getattr(error, "response", None), "headers", None
+    )
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    # Bad requests and auth errors will not get better by retrying
+    name = type(error).__name__
+    return name not in (
+        "InvalidRequestError",
+        "AuthenticationError",
+        "PermissionError",
+        "InvalidArgument",
+        "PermissionDenied",
+        "ValueError",
+    )
+
+
+def openai_timeout(timeout: float) -> dict:
+    return {"request_timeout": timeout}
+
+
+def gemini_timeout(timeout: float) -> dict:
+    return {"request_options": {"timeout": timeout}}
+
+
+def call_provider(
+    provider: str,
+    func: Callable,
+    *args,
+    deadline: float = REQUEST_DEADLINE,
+    timeout_kwargs: Optional[Callable[[float], dict]] = None,
+    **kwargs,
+):
+    """Call func with capped exponential backoff, jitter and a circuit breaker.
+
+    timeout_kwargs turns the time left for an attempt into the backend's own
+    timeout arguments, so the last attempt also ends by the deadline. Meant to
+    run in an executor thread, sleeping between attempts is fine there.
+    """
+    breaker = get_breaker(provider)
+    give_up_at = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        remaining = give_up_at - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{provider} did not answer within {deadline:g}s")
+        breaker.before_call()
+        if timeout_kwargs is not None:
+            kwargs.update(timeout_kwargs(min(ATTEMPT_TIMEOUT, remaining)))
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                # The backend answered, the request itself is wrong
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS or breaker.state == "open":
+                raise
+            # Full jitter, unless the backend told us how long to wait
+            delay = retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+            if time.monotonic() + delay > give_up_at:
+                raise
+            logging.warning(
+                f"{provider} attempt {attempt} failed: {e}, retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+def breaker_report() -> Dict[str, dict]:
+    return {
+        name: {"state": breaker.state, "failures": breaker.failures}
+        for name, breaker in breakers.items()
+    }
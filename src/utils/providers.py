@@ -0,0 +1,170 @@
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Callable, Dict, List, Optional, Tuple
+
+PROCESS_START = time.perf_counter()
+
+
+def configure_openai(module: ModuleType) -> None:
+    module.api_key = os.getenv("OPENAI_API_KEY")
+    module.organization = os.getenv("OPENAI_ORG")
+
+
+def configure_gemini(module: ModuleType) -> None:
+    module.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+
+# Provider name -> (module to import, hook run once right after the import)
+PROVIDERS: Dict[str, Tuple[str, Optional[Callable[[ModuleType], None]]]] = {
+    "openai": ("openai", configure_openai),
+    "gemini": ("google.generativeai", configure_gemini),
+    "bard": ("bardapi", None),
+    "bing": ("EdgeGPT.EdgeUtils", None),
+    "pil": ("PIL.Image", None),
+    "tiktoken": ("tiktoken", None),
+    "ddg": ("duckduckgo_search", None),
+}
+ENABLED_PROVIDERS = [
+    name.strip()
+    for name in os.getenv("ENABLED_PROVIDERS", "openai,tiktoken").split(",")
+    if name.strip()
+]
+
+IMPORT_REPORT_TOP = int(os.getenv("IMPORT_REPORT_TOP", 15))
+
+_loaded: Dict[str, ModuleType] = {}
+_load_lock = threading.Lock()
+# (provider, cumulative import time in us, number of modules pulled in)
+import_times: List[Tuple[str, int, int]] = []
+# Provider -> (module, self us, cumulative us) of every module its import ran
+module_import_times: Dict[str, List[Tuple[str, int, int]]] = {}
+# (stage, time since process start in us)
+startup_stages: List[Tuple[str, int]] = []
+
+
+class _TimedLoader:
+    """Wraps a loader to time module execution, the rest is the real loader."""
+
+    def __init__(self, loader, timer: "ImportTimer") -> None:
+        self.loader = loader
+        self.timer = timer
+
+    def __getattr__(self, attr: str):
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        create = getattr(self.loader, "create_module", None)
+        if create is None:
+            return None
+        # Single phase extension modules run their init here
+        return self.timer.timed(spec.name, create, spec)
+
+    def exec_module(self, module: ModuleType) -> None:
+        # The module only ever sees its real loader
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        self.timer.timed(module.__name__, self.loader.exec_module, module)
+
+
+class ImportTimer:
+    """Per module import times like -X importtime, for imports of one thread."""
+
+    def __init__(self) -> None:
+        self.thread = threading.get_ident()
+        self.times: Dict[str, List[int]] = {}
+        self._children: List[int] = []
+
+    def __enter__(self) -> "ImportTimer":
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        sys.meta_path.remove(self)
+
+    def find_spec(self, name, path, target=None):
+        if threading.get_ident() != self.thread:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def timed(self, name: str, func, *args):
+        self._children.append(0)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = int((time.perf_counter() - start) * 1e6)
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+            times = self.times.setdefault(name, [0, 0])
+            times[0] += elapsed - children
+            times[1] += elapsed
+
+    def report(self) -> List[Tuple[str, int, int]]:
+        return [(name, own, total) for name, (own, total) in self.times.items()]
+
+
+def get_provider(name: str) -> ModuleType:
+    module = _loaded.get(name)
+    if module is not None:
+        return module
+    with _load_lock:
+        if name in _loaded:
+            return _loaded[name]
+        module_name, configure = PROVIDERS[name]
+        modules_before = len(sys.modules)
+        start = time.perf_counter()
+        with ImportTimer() as timer:
+            module = importlib.import_module(module_name)
+        if configure is not None:
+            configure(module)
+        elapsed = int((time.perf_counter() - start) * 1e6)
+        import_times.append((name, elapsed, len(sys.modules) - modules_before))
+        module_import_times[name] = timer.report()
+        _loaded[name] = module
+        logging.debug(f"Provider {name} loaded in {elapsed / 1000:.1f} ms")
+    return module
+
+
+def preload_providers() -> None:
+    for name in ENABLED_PROVIDERS:
+        try:
+            get_provider(name)
+        except Exception as e:
+            logging.error(f"Error occurred while preloading provider {name}: {e}")
+
+
+def record_startup_stage(stage: str) -> None:
+    startup_stages.append((stage, int((time.perf_counter() - PROCESS_START) * 1e6)))
+
+
+def startup_report() -> str:
+    lines = ["startup stage: elapsed [us] | stage"]
+    for stage, elapsed in startup_stages:
+        lines.append(f"startup stage: {elapsed:>12} | {stage}")
+    lines.append("import time: cumulative [us] | modules | provider")
+    for name, elapsed, modules in import_times:
+        lines.append(f"import time: {elapsed:>15} | {modules:>7} | {name}")
+    for name, times in module_import_times.items():
+        slowest = sorted(times, key=lambda t: t[1], reverse=True)[:IMPORT_REPORT_TOP]
+        lines.append(f"{name} imports: self [us] | cumulative | module")
+        for module, own, total in slowest:
+            lines.append(f"{name} imports: {own:>9} | {total:>10} | {module}")
+    not_loaded = sorted(set(PROVIDERS) - set(_loaded))
+    if not_loaded:
+        lines.append(f"not loaded: {', '.join(not_loaded)}")
+    return "\n".join(lines)
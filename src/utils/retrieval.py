@@ -0,0 +1,185 @@
+import glob
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Tuple
+
+from unidecode import unidecode
+
+from .archive import load_archive_index, read_archived_session
+from .message import intern_role
+from .utils import Prompt, chats_path, current_bot
+
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 3))
+RECENT_WINDOW = int(os.getenv("RECENT_WINDOW", 10))
+RETRIEVED_MAX_CHARS = 600
+# Rough memory bound of the loaded indexes, the least recently used chats go first
+RETRIEVAL_CACHE_BYTES = int(os.getenv("RETRIEVAL_CACHE_BYTES", 32 * 1024 * 1024))
+POSTING_BYTES = 64
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+HISTORY_FILENAME = re.compile(r"(-?\d+)_(\d+)\.json$")
+
+
+def terms(text: str) -> List[str]:
+    # Diacritics are folded so Vietnamese typed with or without accents matches
+    return [t for t in re.findall(r"\w+", unidecode(text).lower()) if len(t) > 1]
+
+
+def parse_history_filename(filename: str) -> Tuple[int, int]:
+    match = HISTORY_FILENAME.search(filename)
+    return int(match.group(1)), int(match.group(2))
+
+
+class ChatIndex:
+    """BM25 index over the user and assistant turns of one chat."""
+
+    def __init__(self) -> None:
+        self.docs: List[Tuple[int, int, str, str]] = []  # session, position, role, text
+        self.doc_lens: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.total_len = 0
+        self.size = 0  # Estimated bytes held, for the cache bound
+        self.lock = threading.Lock()
+
+    def add(self, session: int, position: int, message: dict) -> None:
+        if message.get("role") not in ("user", "assistant"):
+            return
+        content = message.get("content") or ""
+        counts = Counter(terms(content))
+        with self.lock:
+            doc_id = len(self.docs)
+            self.docs.append((session, position, intern_role(message["role"]), content))
+            self.doc_lens.append(sum(counts.values()))
+            self.total_len += self.doc_lens[-1]
+            self.size += len(content) + POSTING_BYTES * len(counts)
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+
+    def add_session(self, session: int, messages: Prompt) -> None:
+        for position, message in enumerate(messages):
+            self.add(session, position, message)
+
+    def search(
+        self, query: str, k: int, skip: Tuple[int, int]
+    ) -> List[Tuple[int, int, str, str]]:
+        """Top k turns for query, skipping turns at or after (session, position)."""
+        with self.lock:
+            num_docs = len(self.docs)
+            if not num_docs:
+                return []
+            avg_len = self.total_len / num_docs or 1
+            scores: Dict[int, float] = {}
+            for term in set(terms(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+                for doc_id, tf in postings.items():
+                    if self.docs[doc_id][:2] >= skip:
+                        continue
+                    doc_len = self.doc_lens[doc_id]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)
+                    score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + score
+            best = sorted(scores, key=scores.get, reverse=True)[:k]
+            # Present the hits in the order they were said
+            return [self.docs[doc_id] for doc_id in sorted(best)]
+
+
+_indexes: "OrderedDict[Tuple[str, int], ChatIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _evict(keep: Tuple[str, int]) -> None:
+    # Called with _indexes_lock held, an evicted chat is rebuilt from disk when used
+    total = sum(index.size for index in _indexes.values())
+    for key in list(_indexes):
+        if total <= RETRIEVAL_CACHE_BYTES:
+            break
+        if key != keep:
+            total -= _indexes.pop(key).size
+
+
+def build_chat_index(chat_id: int) -> ChatIndex:
+    index = ChatIndex()
+    sessions = {}
+    for session in load_archive_index(chat_id):
+        sessions[int(session)] = None
+    for filename in glob.glob(f"{chats_path()}history/{chat_id}_*.json"):
+        sessions[parse_history_filename(filename)[1]] = filename
+    for session in sorted(sessions):
+        try:
+            if sessions[session] is None:
+                messages = read_archived_session(chat_id, session) or []
+            else:
+                with open(sessions[session], "r") as f:
+                    messages = json.load(f)["messages"]
+            index.add_session(session, messages)
+        except Exception as e:
+            logging.error(f"Error occurred while indexing {chat_id}_{session}: {e}")
+    logging.debug(f"Built retrieval index for {chat_id} with {len(index.docs)} turns")
+    return index
+
+
+def get_chat_index(chat_id: int) -> ChatIndex:
+    key = (current_bot.get(), chat_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = build_chat_index(chat_id)
+            _evict(key)
+        else:
+            _indexes.move_to_end(key)
+    return index
+
+
+def index_turns(filename: str, start: int, messages: Prompt) -> None:
+    """Add turns appended at position start of a history file to its chat index."""
+    chat_id, session = parse_history_filename(filename)
+    index = _indexes.get((current_bot.get(), chat_id))
+    if index is None:  # Not loaded yet, it will be built from disk on first use
+        return
+    for offset, message in enumerate(messages):
+        index.add(session, start + offset, message)
+    with _indexes_lock:
+        if (current_bot.get(), chat_id) in _indexes:
+            _evict((current_bot.get(), chat_id))
+
+
+def invalidate_chat_index(chat_id: int) -> None:
+    with _indexes_lock:
+        _indexes.pop((current_bot.get(), chat_id), None)
+
+
+def build_context(filename: str, prompt: Prompt) -> Prompt:
+    """System messages, relevant older turns and the recent window of a session."""
+    chat_id, session = parse_history_filename(filename)
+    head = 0
+    while head < len(prompt) and prompt[head]["role"] == "system":
+        head += 1
+    window_start = max(head, len(prompt) - RECENT_WINDOW)
+    context = list(prompt[:head])
+    indexed = (current_bot.get(), chat_id) in _indexes
+    if window_start > head or session > 1 or indexed:
+        query = prompt[-1]["content"]
+        hits = get_chat_index(chat_id).search(
+            query, RETRIEVAL_TOP_K, skip=(session, window_start)
+        )
+        if hits:
+            lines = [f"{role}: {text[:RETRIEVED_MAX_CHARS]}" for *_, role, text in hits]
+            context.append(
+                {
+                    "role": "system",
+                    "content": "Relevant earlier messages from this chat:\n"
+                    + "\n".join(lines),
+                }
+            )
+    context.extend(prompt[window_start:])
+    return context
@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from .tokenizer import num_tokens_near_budget
+from .utils import MODEL_DICT, Prompt
+
+AUTO_MODEL = "auto"
+EXPECTED_REPLY_TOKENS = int(os.getenv("EXPECTED_REPLY_TOKENS", 512))
+
+# Smaller context windows are the cheaper and faster models
+MODELS_BY_WINDOW = sorted(MODEL_DICT, key=lambda key: MODEL_DICT[key][1])
+LARGEST_MODEL = MODELS_BY_WINDOW[-1]
+
+routing_log = deque(maxlen=200)
+routing_stats: Dict[str, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def route_model(
+    messages: Prompt, prefix_tokens: int = 0, pinned: Optional[str] = None
+) -> dict:
+    """Pick the smallest model whose window fits the prompt plus the reply."""
+    if pinned and pinned != AUTO_MODEL:
+        num_tokens = prefix_tokens + num_tokens_near_budget(
+            messages, MODEL_DICT[pinned][1]
+        )
+        return {"model_key": pinned, "prompt_tokens": num_tokens, "reason": "pinned"}
+    num_tokens = None
+    for key in MODELS_BY_WINDOW:
+        budget = MODEL_DICT[key][1] - EXPECTED_REPLY_TOKENS - prefix_tokens
+        # Exact counting kicks in only when the prompt is close to this window
+        num_tokens = prefix_tokens + num_tokens_near_budget(messages, budget)
+        if num_tokens + EXPECTED_REPLY_TOKENS <= MODEL_DICT[key][1]:
+            return {"model_key": key, "prompt_tokens": num_tokens, "reason": "fits"}
+    return {
+        "model_key": LARGEST_MODEL,
+        "prompt_tokens": num_tokens,
+        "reason": "largest",
+    }
+
+
+def record_routing(
+    decision: dict, chat_id: int, latency: float, total_tokens: Optional[int]
+) -> None:
+    decision = dict(
+        decision,
+        chat_id=chat_id,
+        latency=round(latency, 3),
+        total_tokens=total_tokens,
+        time=int(time.time()),
+    )
+    routing_log.append(decision)
+    with _stats_lock:
+        stats = routing_stats.setdefault(
+            decision["model_key"], {"requests": 0, "tokens": 0, "latency": 0.0}
+        )
+        stats["requests"] += 1
+        stats["tokens"] += total_tokens or 0
+        stats["latency"] += latency
+    logging.debug(f"Routed request of {chat_id}: {decision}")
+
+
+def routing_report() -> dict:
+    with _stats_lock:
+        models = {
+            key: {
+                "requests": stats["requests"],
+                "tokens": stats["tokens"],
+                "avg_latency": round(stats["latency"] / stats["requests"], 3),
+            }
+            for key, stats in routing_stats.items()
+        }
+    return {"models": models, "recent": list(routing_log)[-20:]}
+
+
+def routable_models() -> List[str]:
+    return [AUTO_MODEL] + MODELS_BY_WINDOW
+
+
+def model_name(model_key: str) -> str:
+    if model_key == AUTO_MODEL:
+        return "automatic routing"
+    return MODEL_DICT[model_key][0]
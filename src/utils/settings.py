@@ -0,0 +1,162 @@
+import json
+import logging
+import re
+import textwrap
+import threading
+from typing import Dict, Optional, Tuple
+
+from .message import Message
+from .router import AUTO_MODEL, LARGEST_MODEL, routable_models
+from .tokenizer import estimate_tokens_from_messages, num_tokens_from_messages
+from .utils import (
+    MODEL_DICT,
+    SYS_MESS_FRIENDLY,
+    SYS_MESS_SENPAI,
+    Prompt,
+    atomic_write_json,
+    chats_path,
+    current_bot,
+)
+
+DEFAULT_MODEL = AUTO_MODEL
+DEFAULT_PERSONA = "senpai"
+
+
+def normalize_content(text: str) -> str:
+    # Drop the triple-quote indentation and trailing spaces, they are paid tokens
+    text = textwrap.dedent(text).strip()
+    return re.sub(r"[ \t]+\n", "\n", text)
+
+
+class Persona:
+    """System messages of a persona, normalized and counted once."""
+
+    def __init__(self, name: str, messages: Prompt) -> None:
+        self.name = name
+        self.raw_contents = {message["content"] for message in messages}
+        self.messages = [
+            Message(message["role"], normalize_content(message["content"]))
+            for message in messages
+        ]
+        self._num_tokens: Optional[int] = None
+
+    @property
+    def num_tokens(self) -> int:
+        if self._num_tokens is None:
+            try:
+                # The 2 reply priming tokens are counted with the conversation
+                self._num_tokens = num_tokens_from_messages(self.messages) - 2
+            except Exception as e:
+                # Kept, so a missing tokenizer is not retried on every request
+                logging.error(f"Exact token count failed, using estimate: {e}")
+                self._num_tokens = estimate_tokens_from_messages(self.messages) - 2
+        return self._num_tokens
+
+    def is_prefix_message(self, message: dict) -> bool:
+        content = message.get("content")
+        return content in self.raw_contents or any(
+            content == m["content"] for m in self.messages
+        )
+
+
+PERSONAS: Dict[str, Persona] = {
+    "senpai": Persona("senpai", SYS_MESS_SENPAI),
+    "friendly": Persona("friendly", SYS_MESS_FRIENDLY),
+}
+
+
+def strip_persona_prefix(messages: Prompt) -> Prompt:
+    """Sessions written before personas were cached start with their messages."""
+    start = 0
+    while start < len(messages) and any(
+        persona.is_prefix_message(messages[start]) for persona in PERSONAS.values()
+    ):
+        start += 1
+    return messages[start:]
+
+
+def session_filename(chat_id: int) -> str:
+    return f"{chats_path()}session/{chat_id}.json"
+
+
+def load_session_file(chat_id: int) -> dict:
+    try:
+        with open(session_filename(chat_id), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_session_file(chat_id: int, **values) -> None:
+    data = load_session_file(chat_id)
+    data.setdefault("session", 1)
+    data.update(values)
+    atomic_write_json(session_filename(chat_id), data)
+
+
+class ChatSettings:
+    """Model (a MODEL_DICT key or auto routing) and persona used for one chat."""
+
+    def __init__(
+        self,
+        chat_id: int,
+        model_key: str = DEFAULT_MODEL,
+        persona: str = DEFAULT_PERSONA,
+    ) -> None:
+        self.chat_id = chat_id
+        self.model_key = model_key if model_key in routable_models() else DEFAULT_MODEL
+        self.persona_name = persona if persona in PERSONAS else DEFAULT_PERSONA
+
+    @property
+    def max_token(self) -> int:
+        # Routed chats may grow up to the largest window before rolling over, the
+        # tokens left shown with a reply use the window of the routed model
+        if self.model_key == AUTO_MODEL:
+            return MODEL_DICT[LARGEST_MODEL][1]
+        return MODEL_DICT[self.model_key][1]
+
+    @property
+    def persona(self) -> Persona:
+        return PERSONAS[self.persona_name]
+
+
+_chat_settings: Dict[Tuple[str, int], ChatSettings] = {}
+_settings_lock = threading.Lock()
+
+
+def get_chat_settings(chat_id: int) -> ChatSettings:
+    key = (current_bot.get(), chat_id)
+    settings = _chat_settings.get(key)
+    if settings is None:
+        with _settings_lock:
+            settings = _chat_settings.get(key)
+            if settings is None:
+                data = load_session_file(chat_id)
+                settings = ChatSettings(
+                    chat_id,
+                    data.get("model", DEFAULT_MODEL),
+                    data.get("persona", DEFAULT_PERSONA),
+                )
+                _chat_settings[key] = settings
+    return settings
+
+
+def update_chat_settings(
+    chat_id: int, model_key: Optional[str] = None, persona: Optional[str] = None
+) -> ChatSettings:
+    settings = get_chat_settings(chat_id)
+    values = {}
+    if model_key is not None and model_key != settings.model_key:
+        values["model"] = model_key
+    if persona is not None and persona != settings.persona_name:
+        values["persona"] = persona
+    if values:
+        # Replace instead of mutating so requests in flight keep their settings
+        settings = ChatSettings(
+            chat_id,
+            values.get("model", settings.model_key),
+            values.get("persona", settings.persona_name),
+        )
+        _chat_settings[(current_bot.get(), chat_id)] = settings
+        update_session_file(chat_id, **values)
+    return settings
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split()).casefold()
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent identical requests."""
+
+    def __init__(self) -> None:
+        self.calls: Dict[tuple, asyncio.Future] = {}
+        self.started = 0
+        self.shared = 0
+
+    def do(self, key: tuple, func: Callable, *args) -> asyncio.Future:
+        future = self.calls.get(key)
+        if future is None:
+            if asyncio.iscoroutinefunction(func):
+                future = asyncio.ensure_future(func(*args))
+            else:
+                future = asyncio.get_event_loop().run_in_executor(None, func, *args)
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+            self.started += 1
+        else:
+            self.shared += 1
+            logging.debug(f"Joined in-flight call for {key[0]}")
+        # Shielded so one waiter going away does not cancel the others
+        return asyncio.shield(future)
+
+
+flights = SingleFlight()
+
+
+def coalesce(
+    provider: str, prompt: str, func: Callable, *args, persona: Optional[str] = None
+) -> asyncio.Future:
+    """Stateless provider calls only, per-chat conversations must not be shared."""
+    return flights.do((provider, persona, normalize_prompt(prompt)), func, *args)
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from .providers import get_provider
+
+# tiktoken reads its BPE files from TIKTOKEN_CACHE_DIR, point it at a directory we
+# control so encodings survive restarts and can be shipped with the deploy
+TOKENIZER_CACHE_DIR = os.getenv("TOKENIZER_CACHE_DIR", "logs/tiktoken")
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TOKENIZER_CACHE_DIR)
+PRELOAD_ENCODINGS = [
+    name.strip() for name in os.getenv("PRELOAD_ENCODINGS", "cl100k_base").split(",")
+]
+
+# Exact counting is only done once the estimate gets this close to the budget
+ESTIMATE_MARGIN = float(os.getenv("ESTIMATE_MARGIN", 0.15))
+
+# Tokens per character for each script, refined by calibrate_estimator() once an
+# encoding is available. The defaults lean high so estimates stay on the safe side.
+SCRIPT_WEIGHTS = {
+    "ascii": 0.3,
+    "vietnamese": 0.9,
+    "cjk": 1.3,
+    "other": 0.6,
+    "emoji": 2.5,
+}
+CALIBRATION_SAMPLES = {
+    "ascii": "Summarize every thing I send you with specific details, please. "
+    "def main():\n    print('hello world')\n",
+    "vietnamese": "Xin chào, hôm nay trời đẹp quá. Bạn có khỏe không? "
+    "Tôi đang học lập trình Python và rất thích nó.",
+    "cjk": "今天天气很好。我们一起去公园散步吧。日本語のテキストです。",
+    "other": "Привет, как дела? Я собираю статистику сообщений в группе.",
+    "emoji": "🤖🎉😀👍🔥💩🤯🔌",
+}
+
+_encodings: Dict[str, object] = {}
+_encoding_lock = threading.Lock()
+
+
+def char_script(char: str) -> str:
+    code = ord(char)
+    if code < 0x80:
+        return "ascii"
+    if 0xC0 <= code <= 0x24F or 0x1EA0 <= code <= 0x1EFF or 0x300 <= code <= 0x36F:
+        return "vietnamese"
+    if 0x3040 <= code <= 0x9FFF or 0xAC00 <= code <= 0xD7AF:
+        return "cjk"
+    if code >= 0x1F000:
+        return "emoji"
+    return "other"
+
+
+def get_encoding(model: str = "gpt-3.5-turbo"):
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    with _encoding_lock:
+        if model not in _encodings:
+            tiktoken = get_provider("tiktoken")
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def calibrate_estimator(model: str = "gpt-3.5-turbo") -> None:
+    encoding = get_encoding(model)
+    for script, sample in CALIBRATION_SAMPLES.items():
+        scripts = [char_script(c) for c in sample]
+        chars = scripts.count(script)
+        # Other characters in the sample are paid with their current weights
+        rest = sum(SCRIPT_WEIGHTS[s] for s in scripts if s != script)
+        tokens = len(encoding.encode(sample)) - rest
+        if chars and tokens > 0:
+            SCRIPT_WEIGHTS[script] = round(tokens / chars * 1.1, 3)
+    logging.debug(f"Token estimator calibrated: {SCRIPT_WEIGHTS}")
+
+
+def warm_up_tokenizer() -> None:
+    """Load encodings from the on-disk cache, meant to run in an executor."""
+    tiktoken = get_provider("tiktoken")
+    for name in PRELOAD_ENCODINGS:
+        try:
+            _encodings.setdefault(name, tiktoken.get_encoding(name))
+        except Exception as e:
+            logging.error(f"Error occurred while loading encoding {name}: {e}")
+    try:
+        calibrate_estimator()
+        logging.info("Tokenizer warmed up")
+    except Exception as e:
+        logging.error(f"Tokenizer unavailable, using estimates only: {e}")
+
+
+def estimate_tokens(text: str) -> int:
+    weights = SCRIPT_WEIGHTS
+    return int(sum(weights[char_script(c)] for c in text)) + 1
+
+
+def estimate_tokens_from_messages(messages: List[dict]) -> int:
+    num_tokens = 2
+    for message in messages:
+        num_tokens += 4
+        for key, value in message.items():
+            num_tokens += estimate_tokens(value)
+            if key == "name":
+                num_tokens += -1
+    return num_tokens
+
+
+def num_tokens_from_messages(
+    messages: List[dict], model: Optional[str] = "gpt-3.5-turbo"
+) -> int:
+    """Returns the number of tokens used by a list of messages."""
+    if model == "gpt-3.5-turbo":  # note: future models may deviate from this
+        encoding = get_encoding(model)
+        num_tokens = 0
+        for message in messages:
+            # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            num_tokens += 4
+            for key, value in message.items():
+                num_tokens += len(encoding.encode(value))
+                if key == "name":  # if there's a name, the role is omitted
+                    num_tokens += -1  # role is always required and always 1 token
+        num_tokens += 2  # every reply is primed with <im_start>assistant
+        return num_tokens
+    else:
+        raise NotImplementedError(
+            f"""num_tokens_from_messages() is not presently implemented for model {model}."""
+        )
+
+
+def num_tokens_from_text(text: str, model: Optional[str] = "gpt-3.5-turbo") -> int:
+    try:
+        return len(get_encoding(model).encode(text))
+    except Exception as e:
+        logging.error(f"Exact token count failed, using estimate: {e}")
+        return estimate_tokens(text)
+
+
+def num_tokens_near_budget(
+    messages: List[dict], budget: int, model: Optional[str] = "gpt-3.5-turbo"
+) -> int:
+    """Cheap estimate when far below budget, exact count only near the limit."""
+    estimate = estimate_tokens_from_messages(messages)
+    if estimate < budget * (1 - ESTIMATE_MARGIN):
+        return estimate
+    try:
+        return num_tokens_from_messages(messages, model)
+    except Exception as e:
+        logging.error(f"Exact token count failed, using estimate: {e}")
+        return estimate
@@ -0,0 +1,141 @@
+import contextvars
+import glob
+import json
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .archive import (
+    HISTORY_FILE_PATTERN,
+    archive_filenames,
+    archive_path,
+    drop_archived_sessions,
+    load_archive_index,
+    read_archived_session,
+)
+from .retrieval import invalidate_chat_index
+from .settings import load_session_file, update_session_file
+from .message import to_messages
+from .utils import chats_path, current_bot, save_conversation
+
+
+def history_filename(chat_id: int, session: int) -> str:
+    return f"{chats_path()}history/{chat_id}_{session}.json"
+
+
+def list_sessions(chat_id: Optional[int] = None) -> Dict[int, Dict[int, tuple]]:
+    """Map chat_id -> session -> ("file", mtime) or ("archive", retired_at)."""
+    sessions: Dict[int, Dict[int, tuple]] = {}
+    pattern = "*.idx" if chat_id is None else f"{chat_id}.idx"
+    for index_file in glob.glob(f"{archive_path()}{pattern}"):
+        archived_chat = int(os.path.basename(index_file)[: -len(".idx")])
+        for key, (_, _, _, retired_at) in load_archive_index(archived_chat).items():
+            sessions.setdefault(archived_chat, {})[int(key)] = ("archive", retired_at)
+    # A live file wins over an archived copy of the same session
+    for entry in os.scandir(f"{chats_path()}history"):
+        match = HISTORY_FILE_PATTERN.match(entry.name)
+        if not match or (chat_id is not None and int(match.group(1)) != chat_id):
+            continue
+        file_chat, session = int(match.group(1)), int(match.group(2))
+        sessions.setdefault(file_chat, {})[session] = ("file", entry.stat().st_mtime)
+    return sessions
+
+
+def export_history(
+    chat_id: Optional[int] = None,
+    session_from: Optional[int] = None,
+    session_to: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> Iterator[bytes]:
+    """Yield one NDJSON line per session, reading a single session at a time."""
+    for current_chat, sessions in sorted(list_sessions(chat_id).items()):
+        for session, (source, updated_at) in sorted(sessions.items()):
+            if session_from is not None and session < session_from:
+                continue
+            if session_to is not None and session > session_to:
+                continue
+            if (since is not None and updated_at < since) or (
+                until is not None and updated_at > until
+            ):
+                continue
+            try:
+                if source == "file":
+                    with open(history_filename(current_chat, session), "r") as f:
+                        messages = json.load(f)["messages"]
+                else:
+                    messages = read_archived_session(current_chat, session)
+            except (OSError, ValueError, KeyError) as e:
+                # Compacted or cleared while exporting
+                logging.error(
+                    f"Error occurred while exporting {current_chat}_{session}: {e}"
+                )
+                continue
+            record = {
+                "chat_id": current_chat,
+                "session": session,
+                "source": source,
+                "updated_at": int(updated_at),
+                "messages": messages,
+            }
+            yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def bound_to_bot(bot: str, records: Iterator[bytes]) -> Iterator[bytes]:
+    """Pull every record with current_bot set, whichever thread iterates."""
+    context = contextvars.copy_context()
+    context.run(current_bot.set, bot)
+    while True:
+        try:
+            record = context.run(next, records)
+        except StopIteration:
+            return
+        yield record
+
+
+def parse_history_record(line: bytes) -> Tuple[int, int, List[dict]]:
+    record = json.loads(line)
+    chat_id, session, messages = (
+        int(record["chat_id"]),
+        int(record["session"]),
+        record["messages"],
+    )
+    if session < 1 or not isinstance(messages, list):
+        raise ValueError("session must be positive and messages a list")
+    for message in messages:
+        if not isinstance(message, dict) or "role" not in message:
+            raise ValueError("every message needs a role")
+    return chat_id, session, messages
+
+
+def import_history_record(line: bytes, overwrite: bool = False) -> str:
+    """Write one exported session back, returns "imported" or "skipped"."""
+    chat_id, session, messages = parse_history_record(line)
+    filename = history_filename(chat_id, session)
+    archived = str(session) in load_archive_index(chat_id)
+    if os.path.exists(filename) or archived:
+        if not overwrite:
+            return "skipped"
+        if archived:
+            drop_archived_sessions(chat_id, [session])
+    save_conversation(filename, to_messages(messages))
+    # Older sessions are retired and get archived by the compactor
+    if load_session_file(chat_id).get("session", 0) < session:
+        update_session_file(chat_id, session=session)
+    invalidate_chat_index(chat_id)
+    return "imported"
+
+
+def delete_chat_history(chat_id: int) -> int:
+    """Remove the history files and the archive of a chat, returns the sessions."""
+    sessions = {int(key) for key in load_archive_index(chat_id)}
+    for entry in os.scandir(f"{chats_path()}history"):
+        match = HISTORY_FILE_PATTERN.match(entry.name)
+        if match and int(match.group(1)) == chat_id:
+            os.remove(entry.path)
+            sessions.add(int(match.group(2)))
+    for filename in archive_filenames(chat_id):
+        if os.path.exists(filename):
+            os.remove(filename)
+    invalidate_chat_index(chat_id)
+    return len(sessions)
@@ -1,14 +1,17 @@
+import asyncio
 import io
 import json
 import logging
 import os
 import re
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Generator, List, Optional, Tuple
+from typing import Generator, List, Optional, Tuple, Union
 
 import coloredlogs
 import pytz
-import tiktoken
 from dotenv import load_dotenv
 from telethon.errors.rpcerrorlist import PeerIdInvalidError
 from telethon.events import NewMessage
@@ -24,10 +27,12 @@ from telethon.tl.types import (
     User,
 )
 
+from .message import Message, dumps_conversation, to_messages
+
 load_dotenv()
 
-# Prompt typehint
-Prompt = List[dict]
+# Prompt typehint, Message reads like the dict it replaces
+Prompt = List[Union[dict, Message]]
 
 # Bot name
 BOT_NAME = "Minnion"
@@ -82,8 +87,6 @@ SYS_MESS_SENPAI = [
     },
 ]
 
-sys_mess = []
-
 VIETNAMESE_WORDS = "áàảãạăắằẳẵặâấầẩẫậÁÀẢÃẠĂẮẰẲẴẶÂẤẦẨẪẬéèẻẽẹêếềểễệÉÈẺẼẸÊẾỀỂỄỆóòỏõọôốồổỗộơớờởỡợÓÒỎÕỌÔỐỒỔỖỘƠỚỜỞỠỢíìỉĩịÍÌỈĨỊúùủũụưứừửữựÚÙỦŨỤƯỨỪỬỮỰýỳỷỹỵÝỲỶỸỴđĐ"
 LOG_PATH = "logs/"
 RANDOM_ACTION = [
@@ -95,14 +98,11 @@ RANDOM_ACTION = [
     SendMessageChooseStickerAction(),
     SendMessageChooseContactAction(),
 ]
-ALLOW_USERS = eval(os.getenv("ALLOW_USERS"))
 
 MODEL_DICT = {
     "gpt-4k": ("gpt-3.5-turbo-1106", 4096),
     "gpt-16k": ("gpt-3.5-turbo-16k", 16000),
 }
-model = MODEL_DICT["gpt-4k"][0]
-max_token = MODEL_DICT["gpt-4k"][1]
 
 
 def initialize_logging() -> io.StringIO:
@@ -120,13 +120,87 @@ def initialize_logging() -> io.StringIO:
     return console_out
 
 
-def create_initial_folders() -> None:
-    if not os.path.exists(f"{LOG_PATH}chats"):
-        os.mkdir(f"{LOG_PATH}chats")
-    if not os.path.exists(f"{LOG_PATH}chats/history"):
-        os.mkdir(f"{LOG_PATH}chats/history")
-    if not os.path.exists(f"{LOG_PATH}chats/session"):
-        os.mkdir(f"{LOG_PATH}chats/session")
+# Name of the bot serving the current update, "" is the BOTTOKEN bot. Set per
+# handler task, asyncio.to_thread carries it into executor threads
+DEFAULT_BOT = ""
+current_bot: ContextVar[str] = ContextVar("current_bot", default=DEFAULT_BOT)
+
+
+def chats_path(bot: Optional[str] = None) -> str:
+    """Conversation store of a bot, the default bot keeps the original layout."""
+    bot = current_bot.get() if bot is None else bot
+    return f"{LOG_PATH}chats/" if not bot else f"{LOG_PATH}bots/{bot}/chats/"
+
+
+def stored_bots() -> List[str]:
+    """Every bot with a conversation store on disk, the default one first."""
+    bots = [DEFAULT_BOT]
+    if os.path.isdir(f"{LOG_PATH}bots"):
+        bots += sorted(e.name for e in os.scandir(f"{LOG_PATH}bots") if e.is_dir())
+    return bots
+
+
+def create_initial_folders(bot: str = DEFAULT_BOT) -> None:
+    for folder in ("history", "session", "archive"):
+        os.makedirs(f"{chats_path(bot)}{folder}", exist_ok=True)
+
+
+def atomic_write_text(filename: str, text: str) -> None:
+    # Write next to the target then rename, readers never see a half-written file
+    tmp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+
+def atomic_write_json(filename: str, data, **kwargs) -> None:
+    atomic_write_text(filename, json.dumps(data, **kwargs))
+
+
+# Conversations loaded or saved recently, so a request does not parse its session
+# file again. Keyed by filename, valid while the file on disk is the one they
+# were read from or written to
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", 256))
+_conversations: "OrderedDict[str, Tuple[tuple, List[Message]]]" = OrderedDict()
+_conversations_lock = threading.Lock()
+
+
+def _file_key(filename: str) -> tuple:
+    stat = os.stat(filename)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _remember_conversation(
+    filename: str, key: tuple, messages: List[Message]
+) -> None:
+    with _conversations_lock:
+        _conversations[filename] = (key, messages)
+        _conversations.move_to_end(filename)
+        while len(_conversations) > CONVERSATION_CACHE_SIZE:
+            _conversations.popitem(last=False)
+
+
+def save_conversation(filename: str, messages: Prompt) -> None:
+    messages = to_messages(messages)
+    atomic_write_text(filename, dumps_conversation(messages))
+    _remember_conversation(filename, _file_key(filename), messages)
+
+
+def read_conversation(filename: str) -> List[Message]:
+    """Turns of a history file, reused from memory while the file is unchanged."""
+    key = _file_key(filename)
+    with _conversations_lock:
+        cached = _conversations.get(filename)
+        if cached is not None and cached[0] == key:
+            _conversations.move_to_end(filename)
+            # Callers append to the list, the Messages themselves are shared
+            return list(cached[1])
+    with open(filename, "r") as f:
+        messages = to_messages(json.load(f)["messages"])
+    _remember_conversation(filename, key, messages)
+    return list(messages)
 
 
 def get_date_time(zone):
@@ -159,51 +233,25 @@ async def check_chat_type(event: NewMessage):
         logging.error(f"Error occurred when checking chat type: {e}")
 
 
-async def read_existing_conversation(chat_id: int) -> Tuple[int, int, str, Prompt]:
+def load_conversation(chat_id: int) -> Tuple[int, str, Prompt]:
     try:
-        with open(f"{LOG_PATH}chats/session/{chat_id}.json", "r") as f:
+        with open(f"{chats_path()}session/{chat_id}.json", "r") as f:
             file_num = json.load(f)["session"]
-        filename = f"{LOG_PATH}chats/history/{chat_id}_{file_num}.json"
+        filename = f"{chats_path()}history/{chat_id}_{file_num}.json"
         # Create .json file in case of new chat
         if not os.path.exists(filename):
-            data = {"messages": sys_mess}
-            with open(filename, "w") as f:
-                json.dump(data, f, indent=4)
+            save_conversation(filename, [])
         # Load existing chats
-        with open(filename, "r") as f:
-            data = json.load(f)
-        prompt = []
-        for item in data["messages"]:
-            prompt.append(item)
+        prompt = read_conversation(filename)
         logging.debug(f"Successfully read conversation {filename}")
     except Exception as e:
         logging.error(f"Error occurred: {e}")
     return file_num, filename, prompt
 
 
-def num_tokens_from_messages(
-    messages: Prompt, model: Optional[str] = "gpt-3.5-turbo"
-) -> int:
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not presently implemented for model {model}."""
-        )
+async def read_existing_conversation(chat_id: int) -> Tuple[int, str, Prompt]:
+    # Reading and parsing a long history would otherwise block the event loop
+    return await asyncio.to_thread(load_conversation, chat_id)
 
 
 def split_text(
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", 0.1))
+WATCHDOG_THRESHOLD = float(os.getenv("WATCHDOG_THRESHOLD", 0.5))
+WATCHDOG_UNHEALTHY = float(os.getenv("WATCHDOG_UNHEALTHY", 10))
+HEALTH_WINDOW = 60
+MAX_STALLS = 50
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    result = {
+        f"p{p}": ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+        for p in (50, 90, 99)
+    }
+    result["max"] = ordered[-1]
+    return {key: round(value * 1000, 3) for key, value in result.items()}
+
+
+class Watchdog:
+    """Measures event loop lag, a side thread grabs the loop's stack when it stalls.
+
+    The loop cannot report on itself while it is blocked, so a heartbeat task
+    stamps the time on every tick and the thread watches for a stale stamp.
+    """
+
+    def __init__(self) -> None:
+        self.loop_thread_id: Optional[int] = None
+        self.last_beat = time.monotonic()
+        self.lags: Deque[float] = deque(maxlen=int(HEALTH_WINDOW / WATCHDOG_INTERVAL))
+        self.stalls: Deque[dict] = deque(maxlen=MAX_STALLS)
+        self.current_stall: Optional[dict] = None
+        self.lock = threading.Lock()
+
+    async def heartbeat(self) -> None:
+        loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.monitor, name="watchdog", daemon=True).start()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            lag = max(loop.time() - started - WATCHDOG_INTERVAL, 0.0)
+            with self.lock:
+                self.last_beat = time.monotonic()
+                self.lags.append(lag)
+                if self.current_stall is not None:
+                    self.current_stall["seconds"] = round(lag, 3)
+                    self.current_stall["ended_at"] = time.time()
+                    # The stack is empty when the loop thread's frame was not found
+                    stack = self.current_stall["stack"]
+                    where = stack[-1].strip() if stack else "not captured"
+                    logging.warning(
+                        f"Event loop was blocked for {lag:.2f}s, stack: {where}"
+                    )
+                    self.current_stall = None
+
+    def monitor(self) -> None:
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            with self.lock:
+                blocked = time.monotonic() - self.last_beat - WATCHDOG_INTERVAL
+                if blocked < WATCHDOG_THRESHOLD or self.current_stall is not None:
+                    continue
+                # One capture per stall, taken while the blocking call is on the stack
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = traceback.format_stack(frame) if frame is not None else []
+                self.current_stall = {
+                    "started_at": time.time() - blocked,
+                    "ended_at": None,
+                    "seconds": round(blocked, 3),
+                    "stack": stack,
+                }
+                self.stalls.append(self.current_stall)
+            logging.warning(
+                f"Event loop blocked for over {WATCHDOG_THRESHOLD}s:\n{''.join(stack)}"
+            )
+
+    def blocked_for(self) -> float:
+        return max(time.monotonic() - self.last_beat - WATCHDOG_INTERVAL, 0.0)
+
+    def healthy(self) -> bool:
+        # Answered from the loop itself, so a stall is only seen once it ended
+        if self.blocked_for() > WATCHDOG_UNHEALTHY:
+            return False
+        recent = time.time() - HEALTH_WINDOW
+        return not any(
+            stall["seconds"] > WATCHDOG_UNHEALTHY and stall["ended_at"] > recent
+            for stall in self.stalls
+            if stall["ended_at"] is not None
+        )
+
+    def report(self) -> dict:
+        return {
+            "lag_ms": percentiles(list(self.lags)),
+            "blocked_for": round(self.blocked_for(), 3),
+            "stalls": len(self.stalls),
+        }
+
+    def stall_report(self) -> List[dict]:
+        return [dict(stall, stack="".join(stall["stack"])) for stall in self.stalls]
+
+
+watchdog = Watchdog()
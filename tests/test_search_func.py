@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from src.functions import search_func
+
+HITS = [
+    {
+        "title": "Python 3.12 released",
+        "body": "The new release brings faster startup and better error messages",
+        "href": "https://example.com/a",
+    },
+    # Same page with different punctuation, dropped as a near duplicate
+    {
+        "title": "Python 3.12 released!",
+        "body": "The new release brings faster startup and better error messages.",
+        "href": "https://example.com/a",
+    },
+    {
+        "title": "Long review",
+        # Longer than the whole budget on its own
+        "body": " ".join(["benchmark"] * search_func.SEARCH_TOKEN_BUDGET),
+        "href": "https://example.com/b",
+    },
+    {
+        "title": "Changelog",
+        "body": "Per interpreter GIL and f-string grammar",
+        "href": "https://example.com/c",
+    },
+]
+
+
+class CannedReply(dict):
+    @property
+    def content(self) -> str:
+        return self["content"]
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+@pytest.fixture
+def search(monkeypatch, tmp_path):
+    requests = []
+
+    def summary(user_messages):
+        requests.append(user_messages)
+        return CannedReply(role="assistant", content="summary")
+
+    search_func.set_search_source(lambda query, max_results: HITS[:max_results])
+    # Word counts stand in for tiktoken, so the budget is in words
+    monkeypatch.setattr(search_func, "num_tokens_from_text", count_words)
+    monkeypatch.setattr(
+        search_func,
+        "num_tokens_from_messages",
+        lambda messages: sum(count_words(m["content"]) for m in messages),
+    )
+    monkeypatch.setattr(search_func, "get_search_summary", summary)
+    monkeypatch.setattr(search_func, "LOG_PATH", f"{tmp_path}/")
+    yield requests
+    search_func.set_search_source(search_func.ddg_source)
+
+
+def packed_hits(user_messages) -> list:
+    return user_messages[1]["content"].split("\n", 1)[1].splitlines()
+
+
+def test_summarize_search_packs_unique_hits(search):
+    assert asyncio.run(search_func.summarize_search("python 3.12")) == "summary"
+    # The duplicate is dropped, the long review does not fit but the hit after it does
+    assert packed_hits(search[0]) == [
+        "Python 3.12 released: The new release brings faster startup and better"
+        " error messages (https://example.com/a)",
+        "Changelog: Per interpreter GIL and f-string grammar (https://example.com/c)",
+    ]
+
+
+def test_summarize_search_without_hits(search):
+    search_func.set_search_source(lambda query, max_results: [])
+    asyncio.run(search_func.summarize_search("python 3.12"))
+    assert packed_hits(search[0]) == []
@@ -0,0 +1,313 @@
+"""Load generator for the /webhook endpoint of the stats bot (bot.py).
+
+Synthesizes Telegram updates (text messages, commands, joins and callback
+queries) across many chats and users, posts them at a target rate and reports
+ingestion throughput, end-to-end processing lag and SQLite write rate.
+
+    python tools/webhook_loadgen.py --rate 300 --duration 30
+    python tools/webhook_loadgen.py --url http://127.0.0.1:8000 --rate 500
+
+By default bot.py is imported in-process with a fresh database in a temporary
+directory. With --url the updates go to a running server over HTTP, which must
+be started with BOT_API_URL=http://127.0.0.1:<stub-port>. In both cases the
+Bot API is answered by a local stub, nothing is sent to Telegram. Needs the
+dev requirements: pip install -r requirements-dev.txt
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Stats", "username": "stats_bot"}
+DEFAULT_MIX = "text=0.9,command=0.03,join=0.02,callback=0.05"
+WORDS = "привет как дела hello ok да нет lol спасибо thanks кто где когда завтра сегодня".split()
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    result = {f"p{p}": ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in (50, 90, 95, 99)}
+    result["max"] = ordered[-1]
+    return {key: round(value * 1000, 3) for key, value in result.items()}
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - set(UpdateFactory.KINDS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown update kinds: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class BotApiStub:
+    """Answers the Bot API methods used by bot.py and counts the calls."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.message_ids = itertools.count(1_000_000)
+        self.app = FastAPI()
+        self.app.post("/bot{token}/{method}")(self.handle)
+
+    async def handle(self, token: str, method: str, request: Request) -> dict:
+        self.calls[method] += 1
+        body = await request.body()
+        if request.headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+
+class UpdateFactory:
+    """Telegram update JSON, chats and users picked with a skewed (Zipf-like) popularity."""
+
+    KINDS = ("text", "command", "join", "callback")
+
+    def __init__(self, chats: int, users: int, mix: Dict[str, float], seed: Optional[int] = None) -> None:
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.new_users = itertools.count(10_000_000)
+        self.chat_ids = [-1001000000000 - i for i in range(chats)]
+        self.user_ids = [100_000 + i for i in range(users)]
+        self.chat_weights = [1 / (i + 1) for i in range(chats)]
+        self.user_weights = [1 / (i + 1) for i in range(users)]
+        self.kinds = list(mix)
+        self.kind_weights = list(mix.values())
+
+    def pick_chat(self) -> dict:
+        chat_id = self.random.choices(self.chat_ids, self.chat_weights)[0]
+        return {"id": chat_id, "type": "supergroup", "title": f"Load chat {-chat_id % 1000}"}
+
+    def pick_user(self, user_id: Optional[int] = None) -> dict:
+        user_id = user_id or self.random.choices(self.user_ids, self.user_weights)[0]
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "language_code": "ru"}
+
+    def message(self, **fields) -> dict:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self.pick_chat(),
+            "from": self.pick_user(),
+        }
+        message.update(fields)
+        return message
+
+    def make(self) -> Tuple[str, dict]:
+        kind = self.random.choices(self.kinds, self.kind_weights)[0]
+        update = getattr(self, f"make_{kind}")()
+        update["update_id"] = next(self.update_ids)
+        return kind, update
+
+    def make_text(self) -> dict:
+        text = " ".join(self.random.choices(WORDS, k=self.random.randint(1, 12)))
+        return {"message": self.message(text=text)}
+
+    def make_command(self) -> dict:
+        command = self.random.choice(["/stats", "/top"])
+        window = self.random.choice(["", " day", " week", " month"])
+        entity = {"type": "bot_command", "offset": 0, "length": len(command)}
+        return {"message": self.message(text=f"{command}{window}", entities=[entity])}
+
+    def make_join(self) -> dict:
+        member = self.pick_user(next(self.new_users))
+        return {"message": self.message(new_chat_members=[member])}
+
+    def make_callback(self) -> dict:
+        message = self.message(text="📋", **{"from": BOT_USER})
+        return {
+            "callback_query": {
+                "id": str(message["message_id"]),
+                "from": self.pick_user(),
+                "chat_instance": str(message["chat"]["id"]),
+                "message": message,
+                "data": self.random.choice(["stats", "top"]),
+            }
+        }
+
+
+async def send_updates(client: httpx.AsyncClient, factory: UpdateFactory, args: argparse.Namespace) -> dict:
+    total = int(args.rate * args.duration)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    kinds: Counter = Counter()
+    errors = 0
+
+    async def post(update: dict, scheduled: float) -> None:
+        nonlocal errors
+        async with semaphore:
+            try:
+                response = await client.post("/webhook", json=update)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                return
+        # From the scheduled send time, so a backed up client does not hide latency
+        latencies.append(time.perf_counter() - scheduled)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        scheduled = started + i / args.rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind, update = factory.make()
+        kinds[kind] += 1
+        tasks.append(asyncio.create_task(post(update, scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return {
+        "sent": total,
+        "accepted": total - errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round((total - errors) / elapsed, 3) if elapsed else 0.0,
+        "kinds": dict(kinds),
+        "webhook_latency_ms": percentiles(latencies),
+    }
+
+
+async def wait_processed(client: httpx.AsyncClient, expected: int, timeout: float) -> Tuple[dict, float]:
+    started = time.perf_counter()
+    while True:
+        metrics = (await client.get("/metrics")).json()
+        drained = metrics["updates_processed"] >= expected and metrics["pending_counts"] == 0
+        if drained or time.perf_counter() - started > timeout:
+            return metrics, time.perf_counter() - started
+        await asyncio.sleep(0.2)
+
+
+async def run(client: httpx.AsyncClient, stub: BotApiStub, args: argparse.Namespace) -> dict:
+    before = (await client.get("/metrics")).json()
+    factory = UpdateFactory(args.chats, args.users, args.mix, args.seed)
+    report = await send_updates(client, factory, args)
+    expected = before["updates_processed"] + report["accepted"]
+    after, drain_seconds = await wait_processed(client, expected, args.drain_timeout)
+    window = report["seconds"] + drain_seconds
+    rows = after["rows_written"] - before["rows_written"]
+    report.update(
+        {
+            "processed": after["updates_processed"] - before["updates_processed"],
+            "drain_seconds": round(drain_seconds, 3),
+            "processing_lag_ms": after["processing_lag_ms"],
+            "sqlite": {
+                "rows_written": rows,
+                "rows_per_second": round(rows / window, 3) if window else 0.0,
+                "flushes": after["flushes"] - before["flushes"],
+                "flush_latency_ms": after["flush_latency_ms"],
+            },
+            "bot_api_calls": dict(stub.calls),
+        }
+    )
+    return report
+
+
+def print_report(report: dict, rate: float) -> None:
+    print(
+        f"sent        {report['sent']} updates in {report['seconds']}s, "
+        f"{report['throughput']}/s accepted (target {rate}/s), {report['errors']} errors"
+    )
+    print(f"            {', '.join(f'{kind} {count}' for kind, count in report['kinds'].items())}")
+    print(f"webhook     {report['webhook_latency_ms']}")
+    print(f"processed   {report['processed']}/{report['accepted']}, drained in {report['drain_seconds']}s")
+    print(f"lag         {report['processing_lag_ms']}")
+    sqlite = report["sqlite"]
+    print(
+        f"sqlite      {sqlite['rows_written']} rows, {sqlite['rows_per_second']} rows/s, "
+        f"{sqlite['flushes']} flushes, {sqlite['flush_latency_ms']}"
+    )
+    print(f"bot api     {report['bot_api_calls']}")
+
+
+async def main(args: argparse.Namespace) -> dict:
+    stub = BotApiStub(args.api_latency / 1000)
+    server = uvicorn.Server(uvicorn.Config(stub.app, host="127.0.0.1", port=args.stub_port, log_level="warning"))
+    stub_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        if args.url:
+            async with httpx.AsyncClient(base_url=args.url, timeout=30) as client:
+                return await run(client, stub, args)
+        # In-process: the bot talks to the stub and writes to a throwaway database
+        os.environ.update(
+            {
+                "BOT_TOKEN": "123456:loadgen",
+                "WEBHOOK_URL": "http://loadgen.invalid",
+                "BOT_API_URL": f"http://127.0.0.1:{args.stub_port}",
+            }
+        )
+        os.chdir(args.workdir or tempfile.mkdtemp(prefix="loadgen-"))
+        sys.path.insert(0, REPO_ROOT)
+        import bot
+
+        await bot.on_startup()
+        try:
+            transport = httpx.ASGITransport(app=bot.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bot", timeout=30) as client:
+                return await run(client, stub, args)
+        finally:
+            await bot.on_shutdown()
+    finally:
+        server.should_exit = True
+        await stub_task
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="base URL of a running bot.py, in-process when omitted")
+    parser.add_argument("--rate", type=float, default=200, help="updates per second (default 200)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load (default 20)")
+    parser.add_argument("--chats", type=int, default=50, help="number of chats (default 50)")
+    parser.add_argument("--users", type=int, default=2000, help="number of users (default 2000)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"update kinds (default {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight at most (default 100)")
+    parser.add_argument("--stub-port", type=int, default=8081, help="port of the Bot API stub (default 8081)")
+    parser.add_argument("--api-latency", type=float, default=0, help="ms added to every Bot API call (default 0)")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for processing to finish")
+    parser.add_argument("--workdir", help="directory of the in-process database, a temporary one by default")
+    parser.add_argument("--seed", type=int, help="random seed for reproducible runs")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print_report(report, args.rate)